@@ -5,87 +5,390 @@
 import gevent.monkey
 gevent.monkey.patch_all()
 
-from bottle import (route, run, template, static_file,
-                    request, response, install, redirect, BaseRequest)
+from bottle import (route, run, static_file, request, response,
+                    install, hook, redirect, abort, BaseRequest, http_date,
+                    parse_date)
 from bottle.ext.sqlalchemy import Plugin
 from math import ceil
+from calendar import timegm
+from hashlib import sha1
 from uuid import uuid4
-from crypt import crypt
+import os
+import logging
 from datetime import datetime
 
-from sqlalchemy import (create_engine, func, and_, or_)
-from sqlalchemy.orm import sessionmaker
+from gevent.queue import Full
+from sqlalchemy import (func, and_, or_, select, event)
+from sqlalchemy.orm import undefer
 import models
-
-engine = create_engine("sqlite:///./blog.db")
-models.Base.metadata.create_all(engine)
-plugin = Plugin(engine, models.Base.metadata, keyword="db", create=True)
+import migrations
+import search as fulltext
+from cache import (PageCache, Page, TTLCache, SharedPageCache,
+                   SharedTTLCache, SharedRateLimiter)
+from database import (make_engine, make_session, make_read_session,
+                      ReplicaRouter, DATABASE_URL, REPLICA_URLS, POOL_SIZE)
+from templates import TemplateCache
+from assets import Manifest
+from metrics import Instrumentation
+from ingest import ContactQueue, RateLimiter
+from feeds import FeedCache
+from images import ImageStore, Timeout as ImageTimeout
+from passwords import PasswordHasher, Busy
+
+#### Database settings ####
+database_url = DATABASE_URL
+replica_urls = REPLICA_URLS
+pool_size = POOL_SIZE
+pool_max_overflow = 20
+pool_recycle = 3600
+sqlite_busy_timeout = 5000
+slow_query_threshold = 0.1
+slow_query_log = "./slow_query.log"
+replica_lag_window = 5  # seconds reads stay on primary after a write
+replica_max_lag = 5.0
+replica_check_interval = 10.0
+primary_reads_cookie = "primary_reads"
+
+engine, *replicas = [make_engine(url, pool_size=pool_size,
+                                 max_overflow=pool_max_overflow,
+                                 pool_recycle=pool_recycle,
+                                 busy_timeout=sqlite_busy_timeout)
+                     for url in [database_url] + replica_urls]
+migrations.check(engine)  # schema changes go through migrations.py
+search_index = fulltext.create_index(engine)
+router = ReplicaRouter(engine, replicas, lag_window=replica_lag_window,
+                       max_lag=replica_max_lag,
+                       check_interval=replica_check_interval)
+
+instrumentation = Instrumentation(engine, slow_threshold=slow_query_threshold)
+for replica in replicas:
+    instrumentation.watch(replica)
+install(instrumentation)
+slow_query_handler = logging.FileHandler(slow_query_log)
+slow_query_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+logging.getLogger("dummyblog.slowquery").addHandler(slow_query_handler)
+
+# one session per request greenlet, shared by helpers and the db plugin
+session = make_session(engine)
+plugin = Plugin(engine, models.Base.metadata, keyword="db", create=False,
+                create_session=lambda bind: session())
 install(plugin)
-
-Session = sessionmaker(bind=engine)
-session = Session()
-
+# read only helpers go through the router, authors who just wrote carry
+# primary_reads_cookie so they see their own changes despite replica lag
+reads = make_read_session(router,
+                          primary=lambda: bool(request.get_cookie(primary_reads_cookie)))
+
+
+@event.listens_for(session, "after_commit")
+def track_write(db_session):
+    router.wrote()
+    if router.replicas:
+        response.set_cookie(primary_reads_cookie, "1", path="/",
+                            max_age=replica_lag_window)
+
+
+@hook("before_request")
+def sync_caches():
+    """Drop process local caches when another worker invalidated pages.
+
+    the write may not have reached the replicas yet, reading from them
+    now would put the old rows back into the shared cache, so reads go
+    to the primary for one lag window as after a write of our own. An
+    in-memory search index picks up the other worker's changes too."""
+    global cache_generation
+    generation = page_cache.generation()
+    if generation != cache_generation:
+        cache_generation = generation
+        if shared_cache_path:
+            router.wrote()
+            search_index.refresh()
+        invalidate_counts()
+        dashboard_cache.clear()
+        feed_cache.invalidate()
+
+
+@hook("after_request")
+def remove_session():
+    session.remove()
+    reads.remove()
 
 
 #### Settings global variables ####
+debug = os.environ.get("DUMMYBLOG_DEBUG", "") not in ("", "0")
 on_page_articles = 5
+on_page_messages = 10
+max_cached_counts = 1024
+published_counts = {}
+page_cache_size = 32 * 1024 * 1024
 cookie_secret = "`m^2nkxJ>kU}>?NJWb(7'WF}(]p@?/f$2qVS))`"
 cookie_age = 604800
+session_cache_ttl = 300
+dashboard_cache_ttl = 5
+dashboard_preview_length = 175
+template_reload = debug  # recompile changed templates, off in production
+contact_queue_size = 1000
+contact_batch_size = 100
+contact_flush_interval = 1.0
+contact_rate_limit = 5
+contact_rate_period = 60
+login_user_rate_limit = 5  # attempts per username and period
+login_ip_rate_limit = 20
+login_rate_period = 300
+password_workers = 2
+password_max_pending = 16
+site_title = "Dummy Blog"
+# e.g. "https://blog.example.com", feeds and sitemaps are off when unset; the
+# Host header is never used, built files are cached on disk for everyone
+site_url = (os.environ.get("DUMMYBLOG_SITE_URL") or "").rstrip("/") or None
+feed_dir = "./feeds"
+feed_entries = 20
+sitemap_max_urls = 50000
+shared_cache_path = os.environ.get("DUMMYBLOG_SHARED_CACHE")  # set by serve.py
+media_dir = "./media"
+image_widths = (480, 960, 1600, 2400)
+image_quality = 80
+image_workers = 2
+image_max_bytes = 10 * 1024 * 1024
+static_max_age = 3600  # unhashed static urls, their content may change
 BaseRequest.MEMFILE_MAX = 1024 * 1024
+
+asset_manifest = Manifest("./views/static/dist")
+image_store = ImageStore(media_dir, widths=image_widths, quality=image_quality,
+                         workers=image_workers)
+views = TemplateCache("./views", reload=template_reload,
+                      defaults={"asset": asset_manifest.url,
+                                "responsive": image_store.responsive,
+                                "site_url": site_url})
+views.render = instrumentation.track_render(views.render)
+contact_queue = ContactQueue(engine, maxsize=contact_queue_size,
+                             batch_size=contact_batch_size,
+                             flush_interval=contact_flush_interval)
+hasher = PasswordHasher(workers=password_workers,
+                        max_pending=password_max_pending)
+if shared_cache_path:
+    # limits count across all workers and survive recycling
+    page_cache = SharedPageCache(shared_cache_path, page_cache_size)
+    auth_cache = SharedTTLCache(shared_cache_path, session_cache_ttl, name="auth")
+    contact_limiter = SharedRateLimiter(shared_cache_path, contact_rate_limit,
+                                        contact_rate_period, name="contact")
+    login_user_limiter = SharedRateLimiter(shared_cache_path, login_user_rate_limit,
+                                           login_rate_period, name="login_user")
+    login_ip_limiter = SharedRateLimiter(shared_cache_path, login_ip_rate_limit,
+                                         login_rate_period, name="login_ip")
+else:
+    page_cache = PageCache(page_cache_size)
+    auth_cache = TTLCache(session_cache_ttl)
+    contact_limiter = RateLimiter(contact_rate_limit, contact_rate_period)
+    login_user_limiter = RateLimiter(login_user_rate_limit, login_rate_period)
+    login_ip_limiter = RateLimiter(login_ip_rate_limit, login_rate_period)
+cache_generation = page_cache.generation()
+dashboard_cache = TTLCache(dashboard_cache_ttl)
+# feed files on disk are shared by workers, the shared generation tells
+# whether they are still current
+feed_cache = FeedCache(router.read_engine, feed_dir, site_title,
+                       max_urls=sitemap_max_urls, entries=feed_entries,
+                       generation=shared_cache_path and page_cache.generation)
+
 #### Functions ####
 
 def check_session():
 
     session_id = request.get_cookie("sessid", secret=cookie_secret)
     if session_id:
+        auth = auth_cache.get(session_id)
+        if auth is not None:
+            return auth
         author = session.query(models.Author.id, models.Author.username)
         author = author.filter(models.Author.session_id == session_id).first()
         if author:
-            return author.id, author.username
+            auth = author.id, author.username
+            auth_cache.set(session_id, auth)
+            return auth
     return None
 
 
-def select_articles(page=None, search=None, author=None):
-    offset_num = on_page_articles
-    if page:
-        offset_num = on_page_articles * page
+def encode_cursor(created_on, article_id):
+    return "{:%Y%m%d%H%M%S%f}-{}".format(created_on, article_id)
+
+
+def decode_cursor(cursor):
+    try:
+        stamp, article_id = cursor.split("-")
+        return datetime.strptime(stamp, "%Y%m%d%H%M%S%f"), int(article_id)
+    except ValueError:
+        return None
+
+
+def count_articles(search=None, author=None, category=None):
+    """Return number of published articles.
+
+    author and category counts are read from their denormalized
+    article_count columns, search counts come from the index. Counts are
+    cached per filter and dropped by invalidate_counts() whenever an
+    article is written or removed."""
+    key = (search, author, category)
+    if key not in published_counts:
+        if len(published_counts) >= max_cached_counts:
+            published_counts.clear()
+
+        if search:
+            published_counts[key] = search_index.count(reads, search,
+                                                       author=author)
+        elif author:
+            article_count = reads.query(models.Author.article_count)
+            article_count = article_count.filter(models.Author.id == author)
+            published_counts[key] = article_count.scalar() or 0
+        elif category:
+            article_count = reads.query(models.Category.article_count)
+            article_count = article_count.filter(models.Category.id == category)
+            published_counts[key] = article_count.scalar() or 0
+        else:
+            article_count = reads.query(func.count(models.Article.id))
+            article_count = article_count.filter(models.Article.draft == False)
+            published_counts[key] = article_count.scalar()
+    return published_counts[key]
 
-    article_count = session.query(func.count(models.Article.id))
-    article_count = article_count.filter(models.Article.draft == False)
 
-    articles = session.query(models.Article.id, models.Article.title,
-                             models.Article.subtitle, models.Article.created_on,
-                             models.Author.username, models.Author.id)
-    articles = articles.outerjoin(models.Author)
+def invalidate_counts():
+    published_counts.clear()
+
+
+def invalidate_article(article_id, listed=True):
+    """Drop cached counts and pages showing article.
+
+    listed tells whether article is (or was) visible on index pages."""
+    invalidate_counts()
+    page_cache.invalidate("article:{}".format(article_id))
+    if listed:
+        page_cache.invalidate("index")
+        feed_cache.invalidate()
+
+
+def make_etag(*parts):
+    return '"{}"'.format(sha1(repr(parts).encode("utf-8")).hexdigest())
+
+
+def latest(*stamps):
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    return max(stamps) if stamps else None
+
+
+def not_modified(etag, last_modified):
+    """Set validators on response.
+
+    returns True when If-None-Match or If-Modified-Since shows the client
+    copy is still fresh, so handler can answer 304 without rendering."""
+    response.set_header("ETag", etag)
+    if last_modified is not None:
+        response.set_header("Last-Modified", http_date(last_modified))
+
+    none_match = request.headers.get("If-None-Match")
+    if none_match is not None:
+        tags = [tag.strip() for tag in none_match.split(",")]
+        return "*" in tags or etag in tags or "W/" + etag in tags
+
+    since = parse_date(request.headers.get("If-Modified-Since", ""))
+    if since is not None and last_modified is not None:
+        return timegm(last_modified.utctimetuple()) <= since
+    return False
+
+
+def select_articles(page=None, search=None, author=None, category=None,
+                    before=None, after=None):
+    """Return one page of published articles, newest first.
+
+    before/after are decoded (created_on, id) cursors, pages are walked by
+    seeking on the (created_on, id) index so deep pages cost the same as
+    the first one. page without cursor falls back to OFFSET for old links.
+    """
     if search:
-        search = "%" + search + "%"
-        articles = articles.filter(or_(models.Article.title.ilike(search),
-                                       models.article.ilike(search)))
-        article_count = article_count.filter(or_(models.Article.title.ilike(search),
-                                                 models.Article.article.ilike(search)))
-    if author:
-        articles = articles.filter(models.Article.author_id == author)
-        article_count = article_count.filter(models.Article.author_id == author)
+        return search_articles(search, page=page, author=author)
 
-    article_count = article_count.first()
-    off_num = article_count[0] - offset_num
-    off_num = off_num if off_num >= 0 else 0
-    articles = articles.order_by(models.Article.created_on)
+    article_count = count_articles(author=author, category=category)
+    pages = ceil(article_count / on_page_articles)
+
+    articles = reads.query(models.Article.id, models.Article.title,
+                           models.Article.subtitle, models.Article.created_on,
+                           models.Author.username, models.Author.id,
+                           models.Article.updated_on, models.Author.updated_on)
+    articles = articles.outerjoin(models.Author)
     articles = articles.filter(models.Article.draft == False)
-    articles = articles.limit(on_page_articles)
-    articles = articles.offset(off_num)
+    if author:
+        articles = articles.filter(models.Article.author_id == author)
+    if category:
+        articles = articles.filter(models.Article.category_id == category)
+
+    if after:
+        created_on, article_id = after
+        articles = articles.filter(or_(models.Article.created_on > created_on,
+                                       and_(models.Article.created_on == created_on,
+                                            models.Article.id > article_id)))
+        articles = articles.order_by(models.Article.created_on, models.Article.id)
+    else:
+        articles = articles.order_by(models.Article.created_on.desc(),
+                                     models.Article.id.desc())
+        if before:
+            created_on, article_id = before
+            articles = articles.filter(or_(models.Article.created_on < created_on,
+                                           and_(models.Article.created_on == created_on,
+                                                models.Article.id < article_id)))
+        elif page and page > 1:
+            articles = articles.offset(on_page_articles * (page - 1))
+    articles = articles.limit(on_page_articles + 1)
     articles = articles.all()
 
-    pages = ceil(article_count[0] / on_page_articles)
+    has_more = len(articles) > on_page_articles
+    articles = articles[:on_page_articles]
+    if after:
+        articles = articles[::-1]
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = bool(before) or bool(page and page > 1), has_more
+
+    newer = older = None
+    if articles:
+        if has_newer:
+            newer = encode_cursor(articles[0][3], articles[0][0])
+        if has_older:
+            older = encode_cursor(articles[-1][3], articles[-1][0])
+
+    return articles, pages, (newer, older)
+
+def search_articles(search, page=None, author=None):
+    """Return one page of search results ordered by rank.
+
+    rows are the same as select_articles() with highlighted snippet
+    appended, ranked results are paged by number instead of cursor.
+    """
+    page = page if page else 1
+    article_count = count_articles(search=search, author=author)
+    pages = ceil(article_count / on_page_articles)
+
+    hits = search_index.search(reads, search, author=author,
+                               offset=on_page_articles * (page - 1),
+                               limit=on_page_articles)
+    if not hits:
+        return [], pages, (None, None)
+
+    articles = reads.query(models.Article.id, models.Article.title,
+                           models.Article.subtitle, models.Article.created_on,
+                           models.Author.username, models.Author.id,
+                           models.Article.updated_on, models.Author.updated_on)
+    articles = articles.outerjoin(models.Author)
+    articles = articles.filter(models.Article.id.in_([hit[0] for hit in hits]))
+    articles = {article[0]: article for article in articles.all()}
+
+    articles = [tuple(articles[article_id]) + (snippet,)
+                for article_id, snippet in hits if article_id in articles]
+    return articles, pages, (None, None)
 
-    return articles[::-1], pages
 
 def admin_articles(author_id, draft, page=None):
     offset_num = on_page_articles
     if page:
         offset_num = on_page_articles * page
 
-    article_count = session.query(func.count(models.Article.id))
+    article_count = reads.query(func.count(models.Article.id))
     # article_count = article_count.filter(and_(Article.author_id == author_id,
     #                                           Article.draft == draft)).first()
     article_count = article_count.filter(models.Article.author_id == author_id)
@@ -93,8 +396,8 @@ def admin_articles(author_id, draft, page=None):
     off_num = article_count[0] - offset_num
     off_num = off_num if off_num >= 0 else 0
 
-    articles = session.query(models.Article.id,
-                             models.Article.title, models.Article.created_on)
+    articles = reads.query(models.Article.id,
+                           models.Article.title, models.Article.created_on)
     articles = articles.filter(models.Article.author_id == author_id)
     articles = articles.filter(models.Article.draft == draft)
     articles = articles.order_by(models.Article.created_on)
@@ -106,101 +409,290 @@ def admin_articles(author_id, draft, page=None):
 
     return articles[::-1], pages
 
+def newest_row(columns, condition, order):
+    """Return scalar subqueries selecting columns of newest matching row."""
+    return [select(column).where(condition).order_by(order).limit(1)
+            .scalar_subquery() for column in columns]
+
+
+def dashboard_stats():
+    """Return counters and previews shown on /admin.
+
+    everything comes from one statement of scalar subqueries with
+    previews cut in SQL (articles from their stored plain text excerpt),
+    result is cached for dashboard_cache_ttl seconds.
+    """
+    stats = dashboard_cache.get("dashboard")
+    if stats is not None:
+        return stats
+
+    Article, Contact = models.Article, models.Contact
+    article_preview = (Article.title,
+                       func.substr(Article.excerpt, 1, dashboard_preview_length),
+                       Article.created_on)
+    message_preview = (Contact.email,
+                       func.substr(Contact.message, 1, dashboard_preview_length),
+                       Contact.created_on)
+
+    columns = [
+        select(func.count(Article.id)).where(Article.draft == False).scalar_subquery(),
+        select(func.count(Article.id)).where(Article.draft == True).scalar_subquery(),
+        select(func.count(Contact.id)).where(Contact.seen == False).scalar_subquery(),
+        select(func.count(Contact.id)).scalar_subquery(),
+    ]
+    columns += newest_row(article_preview, Article.draft == False, Article.id.desc())
+    columns += newest_row(article_preview, Article.draft == True, Article.id.desc())
+    columns += newest_row(message_preview, Contact.seen == False, Contact.id.desc())
+    columns += newest_row(message_preview, Contact.seen == True, Contact.id.desc())
+    row = reads.execute(select(*columns)).first()
+
+    previews = [tuple(row[i:i + 3]) for i in range(4, 16, 3)]
+    previews = [preview if preview[0] is not None else None for preview in previews]
+    stats = dict(count_posts=row[0], count_drafts=row[1], total_new_m=row[2],
+                 total_messages=row[3], latest_post=previews[0],
+                 latest_draft=previews[1], newest_message=previews[2],
+                 newest_seen_message=previews[3])
+    dashboard_cache.set("dashboard", stats)
+    return stats
+
+
+def select_messages(db, seen=None, before=None, after=None):
+    """Return one page of contact messages, newest first.
+
+    pages are walked by id cursors on the (seen, id) index, seen filters
+    unseen (False) or seen (True) messages, None lists all of them.
+    """
+    messages = db.query(models.Contact.name,
+                        models.Contact.message,
+                        models.Contact.created_on,
+                        models.Contact.seen, models.Contact.id)
+    if seen is not None:
+        messages = messages.filter(models.Contact.seen == seen)
+    if after:
+        messages = messages.filter(models.Contact.id > after)
+        messages = messages.order_by(models.Contact.id)
+    else:
+        if before:
+            messages = messages.filter(models.Contact.id < before)
+        messages = messages.order_by(models.Contact.id.desc())
+    messages = messages.limit(on_page_messages + 1)
+    messages = messages.all()
+
+    has_more = len(messages) > on_page_messages
+    messages = messages[:on_page_messages]
+    if after:
+        messages = messages[::-1]
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = bool(before), has_more
+
+    newer = messages[0][4] if messages and has_newer else None
+    older = messages[-1][4] if messages and has_older else None
+    return messages, (newer, older)
+
+
+def get_article_validator(article_id):
+    """Return (etag, last_modified) of article without loading its body."""
+    query = reads.query(models.Article.created_on, models.Article.updated_on,
+                        models.Author.updated_on)
+    query = query.outerjoin(models.Author)
+    stamps = query.filter(models.Article.id == article_id).first()
+    if stamps is None:
+        return None
+    return make_etag("post", article_id, *stamps), latest(*stamps)
+
+
+def listing_validator(articles, pages, cursors, *parts):
+    """Return (etag, last_modified) of a listing page from its rows."""
+    rows = [(article[0], article[6], article[7]) for article in articles]
+    stamps = [stamp for article in articles for stamp in article[6:8]]
+    return make_etag(pages, cursors, rows, *parts), latest(*stamps)
+
+
 def get_article(article_id):
-    query = session.query(models.Article, models.Author.id, models.Author.username)
+    query = reads.query(models.Article, models.Author.id, models.Author.username)
+    query = query.options(undefer(models.Article.article_html),
+                          undefer(models.Article.toc))
     query = query.outerjoin(models.Author)
     query = query.filter(models.Article.id == article_id)
     article = query.first()
     return article
 
 
+def render_listing(base, page, tags, search=None, author=None, category=None,
+                   owner=None):
+    """Render page of index.html for listing under base path.
+
+    owner loads heading of author and category listings, it is called
+    only on cache miss and returns None for unknown ids."""
+    before = decode_cursor(request.query.before)
+    after = decode_cursor(request.query.after)
+
+    key = (base, page, search, author, category, request.query.before,
+           request.query.after)
+    cached = page_cache.get(key)
+    if cached is None:
+        heading = None
+        if owner is not None:
+            heading = owner()
+            if heading is None:
+                abort(404, "Not found.")
+        articles, pages, cursors = select_articles(page=page, search=search,
+                                                   author=author,
+                                                   category=category,
+                                                   before=before, after=after)
+        etag, last_modified = listing_validator(articles, pages, cursors, base,
+                                                page, search, author, category,
+                                                heading)
+        if not_modified(etag, last_modified):
+            response.status = 304
+            return ""
+        html = views.render("./views/index.html", articles=articles,
+                            max_pages=pages, current_page=page, search=search,
+                            page="index", au=author if base == "/" else "",
+                            cursors=cursors, base=base, heading=heading)
+        tags = tags + tuple({"author:{}".format(article[5])
+                             for article in articles})
+        page_cache.set(key, Page(html, etag, last_modified), tags=tags)
+        return html
+
+    if not_modified(cached.etag, cached.last_modified):
+        response.status = 304
+        return ""
+    return cached.html
+
+
 @route("/")
 @route("/<page:int>")
 def index(page=1):
-    # page = page if page is not None else 1
-    # search = request.query.q if request.query.q else None
-    search = request.query.q
-    authors = request.query.author
+    author = request.query.author
+    return render_listing("/", page, ("index",), search=request.query.q,
+                          author=author if author.isdigit() else "")
+
+
+@route("/authors/<id:int>")
+@route("/authors/<id:int>/<page:int>")
+def author_articles(id, page=1):
+    def owner():
+        author = reads.query(models.Author.username)
+        author = author.filter(models.Author.id == id).first()
+        return "Posts by " + author[0] if author else None
+
+    return render_listing("/authors/{}/".format(id), page,
+                          ("index", "author:{}".format(id)), author=id,
+                          owner=owner)
+
 
-    articles, pages = select_articles(page=page, search=search, author=authors)
-    return template("./views/index.html", articles=articles, max_pages=pages,
-                    current_page=page, search=search, page="index", au=authors)
+@route("/category/<id:int>")
+@route("/category/<id:int>/<page:int>")
+def category_articles(id, page=1):
+    def owner():
+        category = reads.query(models.Category.name)
+        category = category.filter(models.Category.id == id).first()
+        return category[0] if category else None
+
+    return render_listing("/category/{}/".format(id), page, ("index",),
+                          category=id, owner=owner)
 
 
 @route("/post/<id:int>")
 def post(id):
-    article = get_article(id)
-    return template("./views/post.html", article=article, page="post")
+    key = ("post", id)
+    cached = page_cache.get(key)
+    if cached is None:
+        validator = get_article_validator(id)
+        if validator is None:
+            abort(404, "Post not found.")
+        if not_modified(*validator):
+            response.status = 304
+            return ""
+        article = get_article(id)
+        html = views.render("./views/post.html", article=article, page="post")
+        page_cache.set(key, Page(html, *validator),
+                       tags=("article:{}".format(id),
+                             "author:{}".format(article[1])))
+        return html
+
+    if not_modified(cached.etag, cached.last_modified):
+        response.status = 304
+        return ""
+    return cached.html
+
+
+def serve_feed(name, mimetype):
+    """Serve generated feed file, static_file answers conditional GETs."""
+    if site_url is None:
+        abort(404, "Not found.")
+    filename = feed_cache.get(name, site_url)
+    if filename is None:
+        abort(404, "Not found.")
+    return static_file(filename, root=feed_dir, mimetype=mimetype)
+
+
+@route("/sitemap.xml")
+def sitemap():
+    return serve_feed("sitemap.xml", "application/xml")
+
+
+@route("/sitemap-<part:int>.xml")
+def sitemap_part(part):
+    return serve_feed("sitemap-{}.xml".format(part), "application/xml")
+
+
+@route("/rss.xml")
+def rss():
+    return serve_feed("rss.xml", "application/rss+xml")
+
+
+@route("/atom.xml")
+def atom():
+    return serve_feed("atom.xml", "application/atom+xml")
 
 
 @route("/about")
 def about():
-    return template("./views/about.html", page="about")
+    return views.render("./views/about.html", page="about")
 
 
 @route("/contact")
 def contact():
-    return template("./views/contact.html", page="about")
+    return views.render("./views/contact.html", page="about")
 
 
 @route("/contact", method="POST")
-def contact_me(db):
+def contact_me():
     name = request.forms.name
     email = request.forms.email
     message = request.forms.message
     ip = request.environ.get("REMOTE_ADDR")
 
-    data = models.Contact(
+    if not contact_limiter.allow(ip):
+        response.status = 429
+        response.set_header("Retry-After", str(contact_rate_period))
+        return {"status": "TOO_MANY"}
+
+    data = dict(
         name=name,
         message=message,
         email=email,
-        guest_ip=ip
+        guest_ip=ip,
+        seen=False,
+        created_on=datetime.now()
     )
-    db.add(data)
-    db.commit()
+    try:
+        contact_queue.put(data)
+    except Full:
+        response.status = 503
+        response.set_header("Retry-After", "5")
+        return {"status": "BUSY"}
     return {"status": "OK"}
 
 
 @route("/admin")
-def admin(db):
+def admin():
     auth = check_session()
     if auth:
-        count_posts = db.query(func.count(models.Article.id))
-        count_posts = count_posts.filter(models.Article.draft == False).first()
-
-        count_drafts = db.query(func.count(models.Article.id))
-        count_drafts = count_drafts.filter(models.Article.draft == True).first()
-
-        count_m = db.query(func.count(models.Contact.id))
-        total_new_m = count_m.filter(models.Contact.seen == False).first()
-        total_messages = count_m.first()
-
-        latest_article = db.query(models.Article.title, models.Article.article,
-                               models.Article.created_on)
-        latest_post = latest_article.filter(models.Article.draft == False)
-        latest_post = latest_post.order_by(models.Article.id.desc()).limit(1).first()
-
-        latest_draft = latest_article.filter(models.Article.draft == True)
-        latest_draft = latest_draft.order_by(models.Article.id.desc()).limit(1).first()
-
-        message = db.query(models.Contact.email,
-                           models.Contact.message, models.Contact.created_on)
-        newest_message = message.filter(models.Contact.seen == False)
-        newest_message = newest_message.order_by(models.Contact.id.desc()).limit(1)
-        newest_message = newest_message.first()
-
-        newest_seen_message = message.filter(models.Contact.seen == True)
-        newest_seen_message = newest_seen_message.order_by(models.Contact.id.desc())
-        newest_seen_message = newest_seen_message.limit(1)
-        newest_seen_message = newest_seen_message.first()
-
-
-        return template("./views/admin/index.html", count_posts=count_posts[0],
-                        count_drafts=count_drafts[0], total_new_m=total_new_m[0],
-                        total_messages=total_messages[0],
-                        latest_post=latest_post, latest_draft=latest_draft,
-                        newest_message=newest_message,
-                        newest_seen_message=newest_seen_message)
+        return views.render("./views/admin/index.html", **dashboard_stats())
     else:
         redirect("/admin/login")
 
@@ -221,7 +713,7 @@ def admin_new_post(db):
             query = query.filter(and_(models.Article.id == id,
                                       models.Article.author_id == auth[0]))
             article = query.first()
-        return template("./views/admin/editor.html", mode=mode, article=article)
+        return views.render("./views/admin/editor.html", mode=mode, article=article)
     else:
         redirect("/admin/login")
 
@@ -246,6 +738,8 @@ def editor_action(db):
                 author_id=auth[0]
             )
             db.add(new_post)
+            db.commit()
+            invalidate_article(new_post.id, listed=not draft)
         elif mode == "edit":
             id = request.forms.id
             if len(id) is 0:
@@ -254,6 +748,9 @@ def editor_action(db):
             post = db.query(models.Article).filter(and_(models.Article.id == id,
                                                         models.Article.author_id == auth[0]))
             post = post.first()
+            if post is None:
+                abort(404, "Article not found.")
+            listed = not post.draft or not draft
             if post.draft == True and post.draft != draft:
                 post.created_on = datetime.now()
             post.title = title
@@ -261,12 +758,40 @@ def editor_action(db):
             post.header_image = img_url
             post.article = article
             post.draft = draft
+            db.commit()
+            invalidate_article(post.id, listed=listed)
 
-        db.commit()
         redirect("/admin/view?mode=post")
     else:
         redirect("/admin/login")
 
+@route("/admin/images", method="POST")
+def upload_image():
+    auth = check_session()
+    if auth:
+        # checked before request.files, which reads the whole body
+        if request.content_length < 0:
+            response.status = 411
+            return {"status": "FAIL", "error": "length required"}
+        if request.content_length > image_max_bytes + 64 * 1024:
+            response.status = 413
+            return {"status": "FAIL", "error": "image is too large"}
+        upload = request.files.get("image")
+        if upload is None:
+            response.status = 400
+            return {"status": "FAIL", "error": "no image"}
+        try:
+            url = image_store.save(upload.file, image_max_bytes)
+        except ValueError as e:
+            response.status = 400
+            return {"status": "FAIL", "error": str(e)}
+        except ImageTimeout as e:
+            response.status = 503
+            return {"status": "FAIL", "error": str(e)}
+        return {"status": "OK", "url": url}
+    else:
+        return {"status": "you do not have rights!"}
+
 @route("/admin/view")
 @route("/admin/view/<page:int>")
 def admin_view(page=1):
@@ -280,8 +805,8 @@ def admin_view(page=1):
         else:
             redirect("/admin")
 
-        return template("./views/admin/posts.html", articles=articles,
-                        page=page, mode=mode)
+        return views.render("./views/admin/posts.html", articles=articles,
+                            page=page, mode=mode)
     else:
         redirect("/admin/login")
 
@@ -294,8 +819,12 @@ def admin_remove(db):
             query = db.query(models.Article).filter(and_(models.Article.id == id,
                                                   models.Article.author_id == auth[0]))
             article = query.first()
+            if article is None:
+                abort(404, "Article not found.")
+            listed = not article.draft
             db.delete(article)
             db.commit()
+            invalidate_article(id, listed=listed)
             return {"status": "success"}
         else:
             return {"status": "fail"}
@@ -310,42 +839,86 @@ def admin_messages(db, page=None):
         show = request.query.show
         if show:
             message = db.query(models.Contact).filter(models.Contact.id == show).first()
-            message.seen = True
-            return template("./views/admin/message-show.html", message=message)
+            if message is None:
+                abort(404, "Message not found.")
+            if not message.seen:
+                message.seen = True
+                db.commit()
+                dashboard_cache.clear()
+            return views.render("./views/admin/message-show.html", message=message)
         else:
             page = page if page is not None else 1
-            offset_num = 10
-            if page:
-                offset_num = 10 * page
-
-            messages_count = db.query(func.count(models.Contact.id)).first()
-            off_num = messages_count[0] - offset_num
-            off_num = off_num if off_num >= 0 else 0
-
-            messages = db.query(models.Contact.name,
-                                models.Contact.message,
-                                models.Contact.created_on,
-                                models.Contact.seen, models.Contact.id)
-            messages = messages.limit(10)
-            messages = messages.offset(off_num)
-            messages = messages.all()
-
-            pages = ceil(messages_count[0] / 10)
-
-            return template("./views/admin/contact.html", messages=messages,
-                            pages=pages, page=page)
+            status = request.query.status
+            seen = {"unseen": False, "seen": True}.get(status)
+            before = request.query.before
+            after = request.query.after
+            messages, cursors = select_messages(
+                db, seen=seen,
+                before=int(before) if before.isdigit() else None,
+                after=int(after) if after.isdigit() else None)
+
+            # counts come from the cached dashboard statistics
+            stats = dashboard_stats()
+            count = {None: stats["total_messages"],
+                     False: stats["total_new_m"],
+                     True: stats["total_messages"] - stats["total_new_m"]}[seen]
+            pages = max(ceil(count / on_page_messages), 1)
+
+            return views.render("./views/admin/contact.html", messages=messages,
+                                pages=pages, page=page, cursors=cursors,
+                                status=status if seen is not None else "")
     else:
         redirect("/admin/login")
 
 @route("/admin/messages", method="POST")
 def remove_message(db):
+    """Delete or mark messages in one statement.
+
+    msgid can be given several times, action is delete (default), seen
+    or unseen, all=1 with action seen marks every unseen message."""
     auth = check_session()
     if auth:
-        msgid = request.forms.msgid
-        message = db.query(models.Contact).filter(models.Contact.id == msgid).first()
-        db.delete(message)
+        action = request.forms.action or "delete"
+        ids = [int(i) for i in request.forms.getall("msgid") if i.isdigit()]
+
+        messages = db.query(models.Contact)
+        if action == "seen" and request.forms.all:
+            messages = messages.filter(models.Contact.seen == False)
+        elif ids:
+            messages = messages.filter(models.Contact.id.in_(ids))
+        else:
+            return {"status": "FAIL"}
+
+        if action == "delete":
+            count = messages.delete(synchronize_session=False)
+        elif action in ("seen", "unseen"):
+            count = messages.update({models.Contact.seen: action == "seen"},
+                                    synchronize_session=False)
+        else:
+            return {"status": "FAIL"}
         db.commit()
-        return {"status": "OK"}
+        dashboard_cache.clear()
+        return {"status": "OK", "count": count}
+    else:
+        redirect("/admin/login")
+
+
+@route("/admin/cache")
+def admin_cache():
+    auth = check_session()
+    if auth:
+        return page_cache.stats()
+    else:
+        redirect("/admin/login")
+
+
+@route("/admin/metrics")
+def admin_metrics():
+    auth = check_session()
+    if auth:
+        metrics = instrumentation.summary()
+        metrics["page_cache"] = page_cache.stats()
+        return metrics
     else:
         redirect("/admin/login")
 
@@ -358,7 +931,7 @@ def admin_settings(db):
         if mode == "user":
             author = db.query(models.Author).filter(models.Author.id == auth[0]).first()
 
-            return template("./views/admin/usersettings.html", user=author)
+            return views.render("./views/admin/usersettings.html", user=author)
 
         redirect("/admin")
     else:
@@ -383,25 +956,39 @@ def admin_settings_update(db):
 
             author = db.query(models.Author).filter(models.Author.id == auth[0]).first()
 
+            # check the password before touching the row, the db plugin
+            # commits on redirect
+            password = None
+            if oldpassword:
+                if not newpassword:
+                    redirect("/admin")
+                if not login_user_limiter.allow(author.username):
+                    abort(429, "Too many attempts, try again later.")
+                try:
+                    match, rehash = hasher.verify(oldpassword, author.password)
+                    if not match:
+                        redirect("/admin")
+                    login_user_limiter.reset(author.username)
+                    password = hasher.hash(newpassword)
+                except Busy:
+                    abort(503, "Try again later.")
+
             if firstname:
                 author.firstname = firstname
             if lastname:
                 author.lastname = lastname
-            if username:
+            renamed = username and username != author.username
+            if renamed:
                 author.username = username
             if email:
                 author.email = email
-            if oldpassword:
-                md_oldpassword = crypt(oldpassword, salt="MD5")
-                if md_oldpassword == author.password:
-                    if newpassword:
-                        md_newpassword = crypt(newpassword, salt="MD5")
-                        author.password = md_newpassword
-                    else:
-                        redirect("/admin")
-                else:
-                    redirect("/admin")
+            if password:
+                author.password = password
             db.commit()
+            if renamed:
+                auth_cache.delete(author.session_id)
+                page_cache.invalidate("author:{}".format(author.id))
+                feed_cache.invalidate()
             redirect("/admin/settings?mode=user")
 
 
@@ -409,7 +996,7 @@ def admin_settings_update(db):
 def admin_login():
     auth = check_session()
     if auth is None:
-        return template("./views/admin/login.html")
+        return views.render("./views/admin/login.html")
     else:
         redirect("/admin")
 
@@ -417,21 +1004,38 @@ def admin_login():
 @route("/admin/login", method="POST")
 def admin_do_login(db):
     username = request.forms.username
-    password = crypt(request.forms.password, salt="MD5")
+    password = request.forms.password
     if username == "" or password == "":
         return {"status": "FAIL"}
 
-    check_user = db.query(models.Author).filter(and_(models.Author.username == username,
-                                                     models.Author.password == password))
-    check_user = check_user.first()
+    ip = request.environ.get("REMOTE_ADDR")
+    if not (login_ip_limiter.allow(ip) and login_user_limiter.allow(username)):
+        response.status = 429
+        response.set_header("Retry-After", str(login_rate_period))
+        return {"status": "WAIT"}
 
-    if check_user:
+    check_user = db.query(models.Author).filter(models.Author.username == username)
+    check_user = check_user.first()
+    try:
+        match, rehash = hasher.verify(password,
+                                      check_user.password if check_user else None)
+        if match and rehash:
+            check_user.password = hasher.hash(password)
+    except Busy:
+        response.status = 503
+        response.set_header("Retry-After", "5")
+        return {"status": "BUSY"}
+
+    if match:
+        login_user_limiter.reset(username)  # only failures count
         session_id = str(uuid4())
         response.set_cookie("sessid", session_id, secret=cookie_secret,
                             max_age=cookie_age)
 
+        old_session_id = check_user.session_id
         check_user.session_id = session_id
         db.commit()
+        auth_cache.delete(old_session_id)
         return {"status": "OK"}
     else:
         return {"status": "FAIL"}
@@ -442,8 +1046,10 @@ def admin_logout(db):
     if auth is not None:
         author = db.query(models.Author).filter(models.Author.id == auth[0])
         author = author.first()
+        old_session_id = author.session_id
         author.session_id = str(uuid4())
         db.commit()
+        auth_cache.delete(old_session_id)
         response.set_cookie("sessid", "", secret=cookie_secret)
         redirect("/")
     else:
@@ -451,6 +1057,14 @@ def admin_logout(db):
 
 
 #### Static files #####
+@route("/assets/<filename:path>")
+def get_assets(filename):
+    """Callback for built assets.
+
+    return hashed files, precompressed when the client accepts it."""
+    return asset_manifest.serve(filename,
+                                request.headers.get("Accept-Encoding", ""))
+
 @route("/images/<filename>")
 def get_images(filename):
     """Callback for static files.
@@ -458,7 +1072,23 @@ def get_images(filename):
     returning static files from img folder.
     """
     response = static_file(filename, root="./views/static/img")
-    response.set_header("Cache-Control", "public, max-age=25920000")
+    response.set_header("Cache-Control", "public, max-age={:d}".format(static_max_age))
+    return response
+
+@route("/media/<filename>")
+def get_media(filename):
+    """Callback for uploaded images.
+
+    return originals and resized variants, a missing variant is made
+    first; names are content hashes, so they are cached for good."""
+    try:
+        filename = image_store.file(filename)
+    except ImageTimeout:
+        abort(503, "Image is not ready yet.")
+    if filename is None:
+        abort(404, "Image not found.")
+    response = static_file(filename, root=media_dir)
+    response.set_header("Cache-Control", "public, max-age=31536000, immutable")
     return response
 
 @route("/dummy/<filename:path>")
@@ -467,7 +1097,7 @@ def get_css_js(filename):
 
     return css and js files"""
     response = static_file(filename, root="./views/static/dummy")
-    response.set_header("Cache-Control", "public, max-age=25920000")
+    response.set_header("Cache-Control", "public, max-age={:d}".format(static_max_age))
     return response
 
 @route("/vendor/<filename:path>")
@@ -476,7 +1106,7 @@ def get_vendor(filename):
 
     return vendor files"""
     response = static_file(filename, root="./views/static/vendor")
-    response.set_header("Cache-Control", "public, max-age=25920000")
+    response.set_header("Cache-Control", "public, max-age={:d}".format(static_max_age))
     return response
 
 @route("/fonts/<filename>")
@@ -485,10 +1115,10 @@ def get_fonts(filename):
 
     return font files"""
     response = static_file(filename, root="./views/static/fonts")
-    response.set_header("Cache-Control", "public, max-age=25920000")
+    response.set_header("Cache-Control", "public, max-age={:d}".format(static_max_age))
     return response
 
 
 if __name__ == "__main__":
-    run(host="localhost", port=8080, server="gevent", debug=True,
-        reloader=True)
+    run(host="localhost", port=8080, server="gevent", debug=debug,
+        reloader=debug)
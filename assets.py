@@ -0,0 +1,216 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Static asset pipeline.
+
+build step minifies css/js, content-hashes every file under
+views/static and writes gzip (and brotli, when the brotli package is
+installed) variants next to it, plus a manifest mapping the public url
+used in templates (/dummy/css/clean-blog.css) to the hashed one
+(/assets/dummy/css/clean-blog.3f2a9c81d0e4.css).
+
+    python assets.py build
+
+rjsmin and rcssmin are used for minification when installed, css falls
+back to a small built-in minifier and js is then shipped as is.
+"""
+
+import os
+import re
+import json
+import gzip
+import shutil
+import hashlib
+import argparse
+import mimetypes
+from bottle import static_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+# directories under views/static and the url prefix routes serve them on
+PREFIXES = {"img": "/images", "dummy": "/dummy", "vendor": "/vendor",
+            "fonts": "/fonts"}
+COMPRESSIBLE = (".css", ".js", ".svg", ".ttf", ".otf", ".eot", ".json")
+ASSETS_URL = "/assets"
+
+CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+CSS_SPACE_RE = re.compile(r"\s+")
+CSS_PUNCT_RE = re.compile(r"\s*([{};:,>])\s*")
+
+
+def minify_css(source):
+    if rcssmin is not None:
+        return rcssmin.cssmin(source)
+    source = CSS_COMMENT_RE.sub("", source)
+    source = CSS_SPACE_RE.sub(" ", source)
+    source = CSS_PUNCT_RE.sub(r"\1", source)
+    return source.replace(";}", "}").strip()
+
+
+def minify_js(source):
+    if rjsmin is not None:
+        return rjsmin.jsmin(source)
+    return source
+
+
+def minify(path, data):
+    """Return minified bytes of css and js which are not minified yet."""
+    if ".min." in os.path.basename(path):
+        return data
+    if path.endswith(".css"):
+        return minify_css(data.decode("utf-8")).encode("utf-8")
+    if path.endswith(".js"):
+        return minify_js(data.decode("utf-8")).encode("utf-8")
+    return data
+
+
+def hashed_name(path, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    base, ext = os.path.splitext(path)
+    return "{}.{}{}".format(base, digest, ext)
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def build(source="./views/static", target="./views/static/dist"):
+    """Write minified, hashed and precompressed assets and their manifest.
+
+    plain copies are written too, so relative url() references inside
+    css keep resolving from the hashed file.
+    """
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    files = {}
+    for directory, prefix in PREFIXES.items():
+        root = os.path.join(source, directory)
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                relative = os.path.relpath(path, root).replace(os.sep, "/")
+                url = prefix + "/" + relative
+                with open(path, "rb") as f:
+                    data = minify(path, f.read())
+
+                name = prefix.lstrip("/") + "/" + relative
+                hashed = hashed_name(name, data)
+                write(os.path.join(target, name), data)
+                write(os.path.join(target, hashed), data)
+
+                encodings = []
+                if filename.endswith(COMPRESSIBLE):
+                    write(os.path.join(target, hashed + ".gz"),
+                          gzip.compress(data, 9, mtime=0))
+                    encodings.append("gzip")
+                    if brotli is not None:
+                        write(os.path.join(target, hashed + ".br"),
+                              brotli.compress(data, quality=11))
+                        encodings.append("br")
+                files[url] = {"path": hashed, "encodings": encodings}
+
+    os.makedirs(target, exist_ok=True)
+    with open(os.path.join(target, "manifest.json"), "w") as f:
+        json.dump(files, f, indent=1, sort_keys=True)
+    return files
+
+
+def accepted_encodings(header):
+    """Return encodings from Accept-Encoding which are not refused."""
+    encodings = set()
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if name and params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            encodings.add(name.lower())
+    return encodings
+
+
+class Manifest(object):
+    """Hashed url lookup for templates and encoding aware serving.
+
+    when build was not run (no manifest), url() returns the path as given
+    so templates keep working against the plain static routes.
+    """
+
+    max_age = 31536000
+    fallback_max_age = 3600  # files not in the manifest may be replaced
+
+    def __init__(self, root="./views/static/dist"):
+        self.root = root
+        self.urls = {}
+        self.encodings = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(os.path.join(self.root, "manifest.json")) as f:
+                files = json.load(f)
+        except (OSError, ValueError):
+            files = {}
+        self.urls = {url: ASSETS_URL + "/" + entry["path"]
+                     for url, entry in files.items()}
+        self.encodings = {entry["path"]: entry["encodings"]
+                          for entry in files.values()}
+
+    def url(self, path):
+        return self.urls.get(path, path)
+
+    def serve(self, filename, accept_encoding=""):
+        """Return static_file response of hashed asset.
+
+        precompressed variant is picked by Accept-Encoding, brotli first.
+        only files listed in the manifest are cached as immutable.
+        """
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        available = self.encodings.get(filename, ())
+        accepted = accepted_encodings(accept_encoding) if available else ()
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if encoding in available and encoding in accepted:
+                response = static_file(filename + suffix, root=self.root,
+                                       mimetype=mimetype)
+                if response.status_code == 200:
+                    response.set_header("Content-Encoding", encoding)
+                break
+        else:
+            response = static_file(filename, root=self.root, mimetype=mimetype)
+        if available:
+            response.set_header("Vary", "Accept-Encoding")
+        if filename in self.encodings:
+            response.set_header("Cache-Control",
+                                "public, max-age={}, immutable".format(self.max_age))
+        else:
+            response.set_header("Cache-Control",
+                                "public, max-age={}".format(self.fallback_max_age))
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="static asset pipeline")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--source", default="./views/static")
+    parser.add_argument("--target", default="./views/static/dist")
+    args = parser.parse_args()
+
+    files = build(args.source, args.target)
+    print("built {} assets into {}".format(len(files), args.target))
+
+
+if __name__ == "__main__":
+    main()
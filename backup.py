@@ -0,0 +1,290 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Streaming NDJSON export and import of all blog tables.
+
+every line is one JSON object, the first one is a header, every other
+line is {"table": name, "row": {column: value}}. Tables are written in
+foreign key order and rows are streamed with yield_per, so memory stays
+flat whatever the size of the database; files ending with .gz are
+compressed on the fly.
+
+incremental exports keep per-table watermarks (newest updated_on or
+created_on seen) in a state file and only write rows changed since.
+Deleted rows are not tracked, restore a full export to get rid of them.
+
+    python backup.py export full.ndjson.gz
+    python backup.py export nightly.ndjson.gz --state backup.state.json
+    python backup.py import full.ndjson.gz nightly.ndjson.gz
+"""
+
+import os
+import sys
+import gzip
+import json
+import argparse
+from datetime import datetime
+
+from sqlalchemy import (create_engine, select, func, text, inspect, DateTime,
+                        String, Sequence)
+from database import (DATABASE_URL, backfill_excerpts, recount_published,
+                      rerender_articles)
+import models
+import markup
+import migrations
+import search
+
+FORMAT = "dummyblog-export"
+VERSION = 1
+CHUNK = 1000
+
+
+def open_stream(path, mode):
+    if path == "-":
+        return sys.stdout if "w" in mode else sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def tables():
+    """Return model tables, parents before children."""
+    return models.Base.metadata.sorted_tables
+
+
+def existing_columns(engine, table):
+    """Return columns of table present in the database, older files lack
+    the ones added after they were created."""
+    inspector = inspect(engine)
+    if not inspector.has_table(table.name):
+        return []
+    names = {column["name"] for column in inspector.get_columns(table.name)}
+    return [column for column in table.columns if column.name in names]
+
+
+def watermark_column(columns):
+    """Return expression of when row was last written, or None."""
+    columns = {column.name: column for column in columns}
+    columns = [columns[name] for name in ("updated_on", "created_on")
+               if name in columns]
+    if not columns:
+        return None
+    if len(columns) == 1:
+        return columns[0]
+    return func.coalesce(*columns)
+
+
+def dump_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def load_row(table, row):
+    """Turn decoded JSON row back into column values of table.
+
+    rows saved before a string column became required carry nulls,
+    they are loaded as empty strings. Articles exported before sources
+    became Markdown have no article_format, they are html.
+    """
+    values = {}
+    for name, value in row.items():
+        if name not in table.c:
+            continue
+        column = table.c[name]
+        if value is None:
+            if not column.nullable and isinstance(column.type, String):
+                value = ""
+        elif isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        values[name] = value
+    if table.name == "articles":
+        if "article_format" not in row:
+            values["article_format"] = markup.HTML
+        if "article_html" not in row:
+            values["article_html"] = None  # rendered again after import
+    return values
+
+
+def export(engine, out, since=None, chunk=CHUNK):
+    """Write rows of every table to out, newer than since watermarks.
+
+    since maps table name to isoformat watermark, returns new watermarks
+    and number of rows written per table.
+    """
+    since = since or {}
+    marks, counts = {}, {}
+    out.write(json.dumps({"format": FORMAT, "version": VERSION,
+                          "created_on": datetime.now().isoformat(),
+                          "since": since}) + "\n")
+    with engine.connect() as conn:
+        conn = conn.execution_options(yield_per=chunk)
+        for table in tables():
+            columns = existing_columns(engine, table)
+            if not columns:
+                continue
+            stamp = watermark_column(columns)
+            query = select(*columns).order_by(*table.primary_key.columns)
+            if stamp is not None and since.get(table.name):
+                query = query.where(stamp >= datetime.fromisoformat(since[table.name]))
+            count, mark = 0, since.get(table.name)
+            for row in conn.execute(query).mappings():
+                out.write(json.dumps({"table": table.name,
+                                      "row": {k: dump_value(v) for k, v in row.items()}},
+                                     ensure_ascii=False) + "\n")
+                count += 1
+                if stamp is not None:
+                    written = row.get("updated_on") or row.get("created_on")
+                    if written is not None and (mark is None or
+                                                written.isoformat() > mark):
+                        mark = written.isoformat()
+            counts[table.name] = count
+            if mark is not None:
+                marks[table.name] = mark
+    return marks, counts
+
+
+def write_chunk(engine, table, rows):
+    """Upsert rows of table by primary key, one transaction per chunk.
+
+    rows are updated in place, deleting them first would break foreign
+    keys of rows already pointing at them (PostgreSQL enforces those).
+    """
+    key = table.primary_key.columns.values()[0]
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        insert = None
+    with engine.begin() as conn:
+        if insert is None:
+            conn.execute(table.delete().where(key.in_([row[key.name] for row in rows])))
+            conn.execute(table.insert(), rows)
+            return
+        statement = insert(table)
+        updated = {name: statement.excluded[name] for name in rows[0]
+                   if name != key.name}
+        if updated:
+            statement = statement.on_conflict_do_update(index_elements=[key],
+                                                        set_=updated)
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=[key])
+        conn.execute(statement, rows)
+
+
+def reset_sequences(engine):
+    """Move id sequences past the imported ids, inserts with explicit ids
+    leave them behind and the next new row would collide."""
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for table in tables():
+            for column in table.primary_key.columns:
+                sequence = column.default.name \
+                    if isinstance(column.default, Sequence) else None
+                conn.execute(text(
+                    "SELECT setval(CAST(COALESCE(:sequence, "
+                    "pg_get_serial_sequence(:table, :column)) AS regclass), "
+                    "COALESCE(MAX({column}), 0) + 1, false) FROM {table}".format(
+                        column=column.name, table=table.name)),
+                    {"sequence": sequence, "table": table.name,
+                     "column": column.name})
+
+
+def restore(engine, lines, chunk=CHUNK):
+    """Insert rows read from NDJSON lines, returns rows per table.
+
+    existing rows with the same primary key are updated, so importing
+    a full export followed by incremental ones is safe to repeat.
+    """
+    known = {table.name: table for table in tables()}
+    counts = {}
+    table, rows = None, []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if number == 1:
+            if record.get("format") != FORMAT or record.get("version") != VERSION:
+                raise ValueError("not a {} v{} file".format(FORMAT, VERSION))
+            continue
+        target = known.get(record["table"])
+        if target is None:
+            raise ValueError("line {}: unknown table {!r}".format(number,
+                                                                  record["table"]))
+        if target is not table or len(rows) >= chunk:
+            if rows:
+                write_chunk(engine, table, rows)
+            table, rows = target, []
+        rows.append(load_row(target, record["row"]))
+        counts[target.name] = counts.get(target.name, 0) + 1
+    if rows:
+        write_chunk(engine, table, rows)
+    return counts
+
+
+def load_state(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(path, marks):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(marks, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="export and import blog data")
+    parser.add_argument("--db", default=DATABASE_URL,
+                        help="database url")
+    parser.add_argument("--chunk", type=int, default=CHUNK,
+                        help="rows fetched or inserted at once")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write tables as NDJSON")
+    export_parser.add_argument("output", help="file to write, - for stdout")
+    export_parser.add_argument("--state",
+                               help="watermark file, only rows changed since "
+                                    "the previous export are written")
+    import_parser = commands.add_parser("import", help="load NDJSON exports")
+    import_parser.add_argument("inputs", nargs="+",
+                               help="files to read in order, - for stdin")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db)
+    if args.command == "export":
+        since = load_state(args.state)
+        out = open_stream(args.output, "w")
+        try:
+            marks, counts = export(engine, out, since, chunk=args.chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if args.state:
+            save_state(args.state, dict(since, **marks))
+        print("exported {}".format(counts), file=sys.stderr)
+    else:
+        migrations.upgrade(engine)
+        for path in args.inputs:
+            lines = open_stream(path, "r")
+            try:
+                counts = restore(engine, lines, chunk=args.chunk)
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+            print("imported {}: {}".format(path, counts), file=sys.stderr)
+        reset_sequences(engine)
+        rerender_articles(engine, missing_only=True)
+        backfill_excerpts(engine)
+        recount_published(engine)
+        search.rebuild_search(engine)
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""In-process load benchmark.
+
+seeds a database in a temporary directory, imports the real app against
+it and drives the main routes through WSGI. For every route reports
+p50/p95/p99 latency, requests per second and queries per request, plus
+peak RSS of the process, and writes them as JSON so runs of different
+commits can be compared.
+
+    python -m bench.load --articles 20000 --output before.json
+    python -m bench.load --articles 20000 --compare before.json
+"""
+
+import io
+import os
+import sys
+import json
+import atexit
+import shutil
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+from time import perf_counter
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import seed  # noqa: E402
+
+SEARCH_TERMS = ("science", "piracy", "lorem ipsum", "exploration", "zzzz")
+
+
+class Client(object):
+    """Calls a WSGI app in-process and keeps the cookies it sets."""
+
+    def __init__(self, app):
+        self.app = app
+        self.cookies = {}
+
+    def request(self, path, method="GET", form=None):
+        path, _, query = path.partition("?")
+        body = urlencode(form or {}).encode("utf-8")
+        environ = {
+            "REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": query,
+            "SERVER_NAME": "localhost", "SERVER_PORT": "8080",
+            "SERVER_PROTOCOL": "HTTP/1.1", "REMOTE_ADDR": "127.0.0.1",
+            "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr, "CONTENT_LENGTH": str(len(body)),
+            "CONTENT_TYPE": "application/x-www-form-urlencoded",
+            "HTTP_ACCEPT_ENCODING": "gzip, br",
+        }
+        if self.cookies:
+            environ["HTTP_COOKIE"] = "; ".join("{}={}".format(k, v)
+                                               for k, v in self.cookies.items())
+        status = []
+
+        def start_response(code, headers, exc_info=None):
+            status.append(code)
+            for name, value in headers:
+                if name.lower() == "set-cookie":
+                    cookie = value.split(";", 1)[0]
+                    key, _, value = cookie.partition("=")
+                    self.cookies[key] = value.strip('"')
+
+        result = self.app(environ, start_response)
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return int(status[0].split()[0]), body
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(int(round(q / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def routes(rnd, volumes, on_page, messages_on_page=10):
+    """Return {name: (method, path factory, form factory, needs auth)}."""
+    pages = max(int(volumes["articles"] * (1 - volumes["drafts"]) / on_page), 1)
+    message_pages = max(volumes["contacts"] // messages_on_page, 1)
+
+    def contact_form():
+        return {"name": "Bench", "email": "bench@example.com",
+                "message": seed.sentence(rnd, 30)}
+
+    return {
+        "index": ("GET", lambda: "/", None, False),
+        "page": ("GET", lambda: "/{}".format(rnd.randint(2, max(pages, 2))),
+                 None, False),
+        "post": ("GET", lambda: "/post/{}".format(rnd.randint(1, volumes["articles"])),
+                 None, False),
+        "author": ("GET", lambda: "/authors/{}".format(
+            rnd.randint(1, volumes["authors"])), None, False),
+        "category": ("GET", lambda: "/category/{}".format(
+            rnd.randint(1, volumes["categories"])), None, False),
+        "search": ("GET", lambda: "/?" + urlencode({"q": rnd.choice(SEARCH_TERMS)}),
+                   None, False),
+        "admin": ("GET", lambda: "/admin", None, True),
+        "admin_messages": ("GET", lambda: "/admin/messages/{}".format(
+            rnd.randint(1, message_pages)), None, True),
+        "contact": ("POST", lambda: "/contact", contact_form, False),
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="dummyblog-bench-")
+    atexit.register(shutil.rmtree, workdir, True)
+    volumes = seed.seed("sqlite:///" + os.path.join(workdir, "blog.db"),
+                        authors=args.authors, categories=args.categories,
+                        articles=args.articles, contacts=args.contacts,
+                        drafts=args.drafts, seed=args.seed)
+    os.symlink(os.path.join(ROOT, "views"), os.path.join(workdir, "views"))
+    os.chdir(workdir)
+
+    import bottle
+    import gevent
+    import app as blog
+    from sqlalchemy import event
+
+    queries = [0]
+
+    @event.listens_for(blog.engine, "before_cursor_execute")
+    def count_query(*args):
+        queries[0] += 1
+
+    blog.contact_limiter.limit = float("inf")
+
+    def clear_caches():
+        blog.page_cache.clear()
+        blog.invalidate_counts()
+        blog.dashboard_cache.clear()
+
+    wsgi = bottle.default_app()
+    client = Client(wsgi)
+    status, body = client.request("/admin/login", "POST",
+                                  {"username": "author1",
+                                   "password": seed.PASSWORD})
+    if b"OK" not in body:
+        raise SystemExit("benchmark login failed: {}".format(body[:200]))
+
+    rnd = random.Random(args.seed)
+    selected = routes(rnd, volumes, blog.on_page_articles)
+    if args.routes:
+        selected = {name: selected[name] for name in args.routes.split(",")}
+
+    results = {}
+    for name, (method, path, form, auth) in sorted(selected.items()):
+        user = client if auth else Client(wsgi)
+        for _ in range(args.warmup):
+            user.request(path(), method, form() if form else None)
+
+        timings = []
+        errors = 0
+        queries[0] = 0
+        started = perf_counter()
+        for _ in range(args.requests):
+            if args.cold:
+                clear_caches()
+            request_path = path()
+            request_form = form() if form else None
+            begin = perf_counter()
+            status, body = user.request(request_path, method, request_form)
+            timings.append(perf_counter() - begin)
+            if status >= 500:
+                errors += 1
+            # let background greenlets (contact queue flush) run as a server would
+            gevent.sleep(0)
+        elapsed = perf_counter() - started
+
+        results[name] = {
+            "requests": args.requests,
+            "errors": errors,
+            "p50_ms": percentile(timings, 50) * 1000,
+            "p95_ms": percentile(timings, 95) * 1000,
+            "p99_ms": percentile(timings, 99) * 1000,
+            "rps": args.requests / elapsed if elapsed else 0.0,
+            "queries_per_request": queries[0] / float(args.requests),
+        }
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "volumes": volumes,
+            "requests": args.requests,
+            "cold": args.cold,
+        },
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "routes": results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=ROOT, stderr=subprocess.DEVNULL
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(result, baseline=None):
+    header = "{:<16} {:>9} {:>9} {:>9} {:>9} {:>8}".format(
+        "route", "p50 ms", "p95 ms", "p99 ms", "req/s", "queries")
+    print(header)
+    for name, row in sorted(result["routes"].items()):
+        print("{:<16} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.0f} {:>8.1f}".format(
+            name, row["p50_ms"], row["p95_ms"], row["p99_ms"], row["rps"],
+            row["queries_per_request"]))
+        old = (baseline or {}).get("routes", {}).get(name)
+        if old:
+            print("{:<16} {:>+8.0%} {:>+8.0%} {:>+8.0%} {:>+8.0%} {:>+8.1f}".format(
+                "  vs baseline",
+                change(old["p50_ms"], row["p50_ms"]),
+                change(old["p95_ms"], row["p95_ms"]),
+                change(old["p99_ms"], row["p99_ms"]),
+                change(old["rps"], row["rps"]),
+                row["queries_per_request"] - old["queries_per_request"]))
+    print("peak rss: {} KB".format(result["peak_rss_kb"]))
+
+
+def change(old, new):
+    return (new - old) / old if old else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="in-process load benchmark")
+    parser.add_argument("--authors", type=int, default=10)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--articles", type=int, default=5000)
+    parser.add_argument("--contacts", type=int, default=5000)
+    parser.add_argument("--drafts", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=500,
+                        help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--routes", help="comma separated subset of routes")
+    parser.add_argument("--cold", action="store_true",
+                        help="clear app caches before every request")
+    parser.add_argument("--output", help="write JSON result to this file")
+    parser.add_argument("--compare", help="JSON result of a previous run")
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    result = run(args)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Synthetic data generator.
+
+fills a fresh database with authors, categories, articles and contact
+messages with realistic body sizes, so benchmarks do not depend on the
+checked in blog.db.
+
+    python -m bench.seed /tmp/bench/blog.db --articles 20000
+"""
+
+import os
+import random
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert
+from database import recount_published, rerender_articles
+import migrations
+import passwords
+import models
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua enim ad "
+         "minim veniam quis nostrud exercitation ullamco laboris nisi aliquip "
+         "ex ea commodo consequat duis aute irure in reprehenderit voluptate "
+         "velit esse cillum fugiat nulla pariatur excepteur sint occaecat "
+         "cupidatat non proident sunt culpa qui officia deserunt mollit anim "
+         "id est laborum science exploration piracy human heartbeat").split()
+
+PASSWORD = "benchmark"
+CHUNK = 1000
+
+
+def sentence(rnd, words):
+    return " ".join(rnd.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def body(rnd, min_size=1024, max_size=32 * 1024):
+    """Return html article body, size is log-normally spread."""
+    size = int(min(max(rnd.lognormvariate(8.5, 0.7), min_size), max_size))
+    parts = []
+    length = 0
+    while length < size:
+        if rnd.random() < 0.15:
+            part = "<h2>{}</h2>".format(sentence(rnd, 6))
+        else:
+            part = "<p>{}.</p>".format(sentence(rnd, rnd.randint(30, 120)))
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def chunks(rows, size=CHUNK):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed(url, authors=10, categories=20, articles=10000, contacts=5000,
+         drafts=0.1, seed=1):
+    """Create tables at url and fill them, returns volumes used."""
+    rnd = random.Random(seed)
+    engine = create_engine(url)
+    migrations.create(engine)
+    start = datetime(2015, 1, 1)
+    password = passwords.encode(PASSWORD, os.urandom(16), passwords.N,
+                                passwords.R, passwords.P)
+
+    def author_rows():
+        for i in range(1, authors + 1):
+            yield dict(id=i, username="author{}".format(i),
+                       firstname="Author", lastname=str(i), password=password,
+                       email="author{}@example.com".format(i))
+
+    def category_rows():
+        for i in range(1, categories + 1):
+            yield dict(id=i, name="category {}".format(i))
+
+    def article_rows():
+        step = timedelta(minutes=30)
+        for i in range(1, articles + 1):
+            created = start + step * i
+            yield dict(id=i, title=sentence(rnd, rnd.randint(4, 12)),
+                       subtitle=sentence(rnd, rnd.randint(6, 16)),
+                       header_image="/images/post-bg.jpg", article=body(rnd),
+                       draft=rnd.random() < drafts,
+                       category_id=rnd.randint(1, categories),
+                       author_id=rnd.randint(1, authors),
+                       created_on=created, updated_on=created)
+
+    def contact_rows():
+        step = timedelta(minutes=45)
+        for i in range(1, contacts + 1):
+            yield dict(id=i, name=sentence(rnd, 2)[:100],
+                       email="guest{}@example.com".format(i),
+                       message=sentence(rnd, rnd.randint(10, 60))[:500],
+                       guest_ip="10.0.{}.{}".format(i // 256 % 256, i % 256),
+                       seen=rnd.random() < 0.7,
+                       created_on=start + step * i)
+
+    with engine.begin() as conn:
+        for table, rows in ((models.Author, author_rows()),
+                            (models.Category, category_rows()),
+                            (models.Article, article_rows()),
+                            (models.Contact, contact_rows())):
+            for chunk in chunks(rows):
+                conn.execute(insert(table), chunk)
+    rerender_articles(engine)
+    recount_published(engine)
+    engine.dispose()
+    return dict(authors=authors, categories=categories, articles=articles,
+                contacts=contacts, drafts=drafts, seed=seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="seed a benchmark database")
+    parser.add_argument("path", help="sqlite file to create")
+    parser.add_argument("--authors", type=int, default=10)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--articles", type=int, default=10000)
+    parser.add_argument("--contacts", type=int, default=5000)
+    parser.add_argument("--drafts", type=float, default=0.1,
+                        help="share of articles saved as drafts")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        parser.error("{} already exists".format(args.path))
+    volumes = seed("sqlite:///" + args.path, authors=args.authors,
+                   categories=args.categories, articles=args.articles,
+                   contacts=args.contacts, drafts=args.drafts, seed=args.seed)
+    print("seeded {}: {}".format(args.path, volumes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Template render benchmark.
+
+renders index, post and admin dashboard pages against seeded rows and
+prints renders per second for the precompiled TemplateCache and for
+bottle's template() the way debug mode runs it. Templates get the same
+helpers (asset, responsive) as in the app, image variants are kept in
+a temporary directory.
+
+run from repository root:
+
+    python -m bench.templates --seconds 2
+"""
+
+import argparse
+import random
+import tempfile
+from collections import namedtuple
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import bottle
+import markup
+from assets import Manifest
+from images import ImageStore
+from templates import TemplateCache
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+SeededArticle = namedtuple("SeededArticle", "id title subtitle article "
+                           "article_html toc reading_time header_image "
+                           "created_on updated_on")
+
+
+def sentence(rnd, words):
+    return " ".join(rnd.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def seed(rnd, body_paragraphs=20):
+    """Return template arguments for every benchmarked page."""
+    now = datetime(2017, 2, 15)
+    rows = []
+    for i in range(5):
+        created = now - timedelta(hours=i)
+        rows.append((100 - i, sentence(rnd, 8), sentence(rnd, 12), created,
+                     "author", 1, created, created))
+
+    body = "\n\n".join("## {}\n\n{}".format(sentence(rnd, 4), sentence(rnd, 80))
+                       if i % 5 == 0 else sentence(rnd, 80)
+                       for i in range(body_paragraphs))
+    rendered = markup.render(body)
+    article = SeededArticle(100, sentence(rnd, 8), sentence(rnd, 12), body,
+                            rendered.html, rendered.toc, rendered.reading_time,
+                            "/images/post-bg.jpg", now, now)
+
+    preview = (sentence(rnd, 6), rendered.text[:175], now)
+    dashboard = dict(count_posts=1200, count_drafts=40, total_new_m=7,
+                     total_messages=300, latest_post=preview,
+                     latest_draft=preview, newest_message=preview,
+                     newest_seen_message=preview)
+
+    return {
+        "index": ("./views/index.html",
+                  dict(articles=rows, max_pages=240, current_page=1,
+                       search="", page="index", au="",
+                       cursors=(None, "20170215000000000000-96"), base="/",
+                       heading=None)),
+        "post": ("./views/post.html",
+                 dict(article=(article, 1, "author"), page="post")),
+        "admin": ("./views/admin/index.html", dashboard),
+    }
+
+
+def measure(render, seconds):
+    count = 0
+    start = perf_counter()
+    deadline = start + seconds
+    while perf_counter() < deadline:
+        for _ in range(50):
+            render()
+        count += 50
+    return count / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=2.0,
+                        help="time spent on every page and renderer")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    pages = seed(random.Random(args.seed))
+    media = tempfile.TemporaryDirectory()
+    image_store = ImageStore(media.name)
+    defaults = {"asset": Manifest().url, "responsive": image_store.responsive}
+    cache = TemplateCache("./views", defaults=defaults)
+    reloading = TemplateCache("./views", reload=True, defaults=defaults)
+
+    def bottle_debug(name, kwargs):
+        bottle.DEBUG = True
+        try:
+            return bottle.template(name, defaults, **kwargs)
+        finally:
+            bottle.DEBUG = False
+
+    renderers = [
+        ("bottle debug", bottle_debug),
+        ("bottle cached",
+         lambda name, kwargs: bottle.template(name, defaults, **kwargs)),
+        ("precompiled", lambda name, kwargs: cache.render(name, **kwargs)),
+        ("precompiled+mtime", lambda name, kwargs: reloading.render(name, **kwargs)),
+    ]
+
+    print("{:<8} {:<20} {:>12}".format("page", "renderer", "renders/s"))
+    for page, (name, kwargs) in sorted(pages.items()):
+        for label, renderer in renderers:
+            rate = measure(lambda: renderer(name, kwargs), args.seconds)
+            print("{:<8} {:<20} {:>12.0f}".format(page, label, rate))
+    media.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Caches of rendered pages and short lived lookups.
+
+PageCache and TTLCache live in process memory, the Shared* variants keep
+the same interface in a sqlite file so pre-forked workers (serve.py)
+share one warm cache. SharedRateLimiter does the same for
+ingest.RateLimiter, so limits hold across workers and restarts.
+"""
+
+import os
+import pickle
+import sqlite3
+from time import monotonic, time
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict, namedtuple
+
+Page = namedtuple("Page", "html etag last_modified")
+
+
+class PageCache(object):
+    """LRU cache of rendered pages bounded by total size of html in bytes.
+
+    every entry can carry tags ("article:3", "author:1", "index") so
+    writes invalidate exactly the pages showing changed rows.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.tags = defaultdict(set)
+        self.invalidations = 0
+
+    def generation(self):
+        """Number changing whenever entries were invalidated."""
+        return self.invalidations
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, page, tags=()):
+        size = len(page.html.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = (page, size, tags)
+        self.size += size
+        for tag in tags:
+            self.tags[tag].add(key)
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        page, size, tags = entry
+        self.size -= size
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of tags."""
+        self.invalidations += 1
+        for tag in tags:
+            for key in list(self.tags.get(tag, ())):
+                self.remove(key)
+
+    def clear(self):
+        self.invalidations += 1
+        self.entries.clear()
+        self.tags.clear()
+        self.size = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.size,
+                "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses}
+
+
+class TTLCache(object):
+    """Small mapping whose entries expire ttl seconds after set()."""
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < monotonic():
+            self.entries.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value):
+        if len(self.entries) >= self.max_entries:
+            now = monotonic()
+            for k in [k for k, e in self.entries.items() if e[1] < now]:
+                del self.entries[k]
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+        self.entries[key] = (value, monotonic() + self.ttl)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SharedStore(object):
+    """sqlite file opened once per process, reopened after fork."""
+
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.conn = None
+        with self.transaction() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def connect(self):
+        if self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=5,
+                                        isolation_level=None,
+                                        check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=OFF")
+            self.pid = os.getpid()
+        return self.conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class SharedPageCache(SharedStore):
+    """PageCache kept in sqlite file shared by worker processes.
+
+    size bound evicts entries stored first instead of least recently
+    read, so reads never write. generation is bumped on every
+    invalidation, workers compare it to drop their own derived caches.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, "
+        "page BLOB NOT NULL, size INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS page_tags (tag TEXT NOT NULL, "
+        "key TEXT NOT NULL, PRIMARY KEY (tag, key)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS ix_page_tags_key ON page_tags (key)",
+        "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, "
+        "value INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO meta VALUES ('bytes', 0), ('generation', 0)",
+    )
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        super().__init__(path)
+
+    def generation(self):
+        return self.connect().execute("SELECT value FROM meta WHERE "
+                                      "name = 'generation'").fetchone()[0]
+
+    def get(self, key):
+        row = self.connect().execute("SELECT page FROM pages WHERE key = ?",
+                                     (repr(key),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return Page(*pickle.loads(row[0]))
+
+    def set(self, key, page, tags=()):
+        size = len(page.html.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        key = repr(key)
+        with self.transaction() as conn:
+            self._remove(conn, key)
+            conn.execute("INSERT INTO pages VALUES (?, ?, ?)",
+                         (key, pickle.dumps(tuple(page)), size))
+            conn.executemany("INSERT OR IGNORE INTO page_tags VALUES (?, ?)",
+                             [(tag, key) for tag in tags])
+            total = self._grow(conn, size)
+            while total > self.max_bytes:
+                oldest = conn.execute("SELECT key FROM pages ORDER BY rowid "
+                                      "LIMIT 1").fetchone()
+                total = self._remove(conn, oldest[0])
+
+    def _grow(self, conn, size):
+        conn.execute("UPDATE meta SET value = value + ? WHERE name = 'bytes'",
+                     (size,))
+        return conn.execute("SELECT value FROM meta WHERE "
+                            "name = 'bytes'").fetchone()[0]
+
+    def _remove(self, conn, key):
+        row = conn.execute("SELECT size FROM pages WHERE key = ?",
+                           (key,)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+            conn.execute("DELETE FROM page_tags WHERE key = ?", (key,))
+        return self._grow(conn, -row[0] if row else 0)
+
+    def remove(self, key):
+        with self.transaction() as conn:
+            self._remove(conn, repr(key))
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of tags."""
+        marks = ", ".join("?" * len(tags))
+        with self.transaction() as conn:
+            keys = conn.execute("SELECT DISTINCT key FROM page_tags WHERE tag "
+                                "IN ({})".format(marks), tags).fetchall()
+            for key, in keys:
+                self._remove(conn, key)
+            conn.execute("UPDATE meta SET value = value + 1 WHERE "
+                         "name = 'generation'")
+
+    def clear(self):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM pages")
+            conn.execute("DELETE FROM page_tags")
+            conn.execute("UPDATE meta SET value = 0 WHERE name = 'bytes'")
+            conn.execute("UPDATE meta SET value = value + 1 WHERE "
+                         "name = 'generation'")
+
+    def stats(self):
+        entries, size = self.connect().execute(
+            "SELECT count(*), total(size) FROM pages").fetchone()
+        return {"entries": entries, "bytes": int(size),
+                "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses, "shared": self.path}
+
+
+class SharedTTLCache(SharedStore):
+    """TTLCache kept in sqlite file, name separates caches in one file.
+
+    expired entries are pruned every 100 writes."""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS ttl_entries (cache TEXT NOT NULL, "
+        "key TEXT NOT NULL, value BLOB NOT NULL, expires REAL NOT NULL, "
+        "PRIMARY KEY (cache, key)) WITHOUT ROWID",
+    )
+
+    def __init__(self, path, ttl, name="ttl"):
+        self.ttl = ttl
+        self.name = name
+        self.writes = 0
+        super().__init__(path)
+
+    def get(self, key):
+        row = self.connect().execute(
+            "SELECT value FROM ttl_entries WHERE cache = ? AND key = ? AND "
+            "expires >= ?", (self.name, repr(key), time())).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def set(self, key, value):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO ttl_entries VALUES (?, ?, ?, ?)",
+                         (self.name, repr(key), pickle.dumps(value),
+                          time() + self.ttl))
+            self.writes += 1
+            if self.writes % 100 == 0:
+                conn.execute("DELETE FROM ttl_entries WHERE cache = ? AND "
+                             "expires < ?", (self.name, time()))
+
+    def delete(self, key):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM ttl_entries WHERE cache = ? AND key = ?",
+                         (self.name, repr(key)))
+
+    def clear(self):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM ttl_entries WHERE cache = ?", (self.name,))
+
+
+class SharedRateLimiter(SharedStore):
+    """ingest.RateLimiter kept in sqlite file, name separates limiters.
+
+    events older than period are pruned for the key on every call and
+    for all keys every 1000 calls."""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS rate_events (limiter TEXT NOT NULL, "
+        "key TEXT NOT NULL, at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_rate_events_key ON rate_events "
+        "(limiter, key, at)",
+    )
+
+    def __init__(self, path, limit, period, name="rate"):
+        self.limit = limit
+        self.period = period
+        self.name = name
+        self.calls = 0
+        super().__init__(path)
+
+    def allow(self, key):
+        now = time()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM rate_events WHERE limiter = ? AND key = ? "
+                         "AND at <= ?", (self.name, repr(key), now - self.period))
+            self.calls += 1
+            if self.calls % 1000 == 0:
+                conn.execute("DELETE FROM rate_events WHERE limiter = ? AND "
+                             "at <= ?", (self.name, now - self.period))
+            count = conn.execute("SELECT count(*) FROM rate_events WHERE "
+                                 "limiter = ? AND key = ?",
+                                 (self.name, repr(key))).fetchone()[0]
+            if count >= self.limit:
+                return False
+            conn.execute("INSERT INTO rate_events VALUES (?, ?, ?)",
+                         (self.name, repr(key), now))
+        return True
+
+    def reset(self, key):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM rate_events WHERE limiter = ? AND key = ?",
+                         (self.name, repr(key)))
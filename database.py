@@ -0,0 +1,255 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Engine and session setup, read replica routing, batched data backfills.
+
+connection settings come from the environment so the same code runs
+on a local sqlite file or on PostgreSQL with replicas:
+
+    DUMMYBLOG_DATABASE_URL   primary, default sqlite:///./blog.db
+    DUMMYBLOG_REPLICA_URLS   comma separated read replicas
+    DUMMYBLOG_POOL_SIZE      connections kept per engine
+"""
+
+import os
+import logging
+from itertools import count
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic
+
+from sqlalchemy import create_engine, event, select, func, bindparam, text
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
+from sqlalchemy.orm import sessionmaker, scoped_session
+import models
+import markup
+
+log = logging.getLogger("dummyblog.database")
+
+DATABASE_URL = os.environ.get("DUMMYBLOG_DATABASE_URL", "sqlite:///./blog.db")
+REPLICA_URLS = [url.strip() for url in
+                os.environ.get("DUMMYBLOG_REPLICA_URLS", "").split(",")
+                if url.strip()]
+POOL_SIZE = int(os.environ.get("DUMMYBLOG_POOL_SIZE", 10))
+
+
+def make_engine(url, pool_size=10, max_overflow=20, pool_recycle=3600,
+                pool_timeout=30, busy_timeout=5000):
+    """Create pooled engine for url.
+
+    threading primitives of the pool are patched by gevent, so greenlets
+    wait on the pool instead of sharing one connection. sqlite files are
+    switched to WAL so readers do not block on the writer.
+    """
+    engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                           pool_recycle=pool_recycle, pool_timeout=pool_timeout,
+                           pool_pre_ping=True)
+
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragma(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA busy_timeout={:d}".format(busy_timeout))
+            cursor.close()
+
+    return engine
+
+
+def make_session(engine):
+    """Return session registry scoped to current greenlet.
+
+    gevent patches threading.local, so every request greenlet gets its
+    own session; call remove() when the request is done.
+    """
+    return scoped_session(sessionmaker(bind=engine))
+
+
+class ReplicaRouter(object):
+    """Picks engine for read only work.
+
+    reads go round robin to replicas whose lag is below max_lag, and to
+    the primary when there is none, when this process committed less than
+    lag_window seconds ago (caches are refilled with fresh rows) or when
+    the caller asks for it (author who just wrote). Replica health is
+    checked every check_interval seconds, lag is measured on PostgreSQL
+    only, other replicas just have to answer; a replica failing a query is
+    dropped until the next check.
+    """
+
+    LAG_QUERIES = {
+        "postgresql": "SELECT COALESCE(EXTRACT(EPOCH FROM now() - "
+                      "pg_last_xact_replay_timestamp()), 0)",
+    }
+    PROBE_QUERY = "SELECT 0 FROM schema_version"
+
+    def __init__(self, primary, replicas=(), lag_window=5.0, max_lag=5.0,
+                 check_interval=10.0):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.healthy = list(replicas)
+        self.lag_window = lag_window
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.next_check = 0.0
+        self.last_write = None
+        self.counter = count()
+        for replica in self.replicas:
+            event.listen(replica, "handle_error", self.failed)
+
+    def failed(self, context):
+        """Take replica out of rotation until next check on database errors."""
+        if isinstance(context.sqlalchemy_exception, OperationalError):
+            self.healthy = [replica for replica in self.healthy
+                            if replica is not context.engine]
+
+    def wrote(self):
+        self.last_write = monotonic()
+
+    def fresh(self):
+        """Tell whether replicas may still miss this process' last write."""
+        return (self.last_write is not None and
+                monotonic() - self.last_write < self.lag_window)
+
+    def lag(self, engine):
+        query = self.LAG_QUERIES.get(engine.dialect.name, self.PROBE_QUERY)
+        with engine.connect() as conn:
+            return float(conn.execute(text(query)).scalar() or 0)
+
+    def check(self):
+        healthy = []
+        for replica in self.replicas:
+            try:
+                lag = self.lag(replica)
+            except SQLAlchemyError:
+                log.warning("replica %s is down", replica.url, exc_info=True)
+                continue
+            if lag > self.max_lag:
+                log.warning("replica %s is %.1fs behind", replica.url, lag)
+                continue
+            healthy.append(replica)
+        self.healthy = healthy
+
+    def read_engine(self, primary=False):
+        if primary or not self.replicas or self.fresh():
+            return self.primary
+        now = monotonic()
+        if now >= self.next_check:
+            self.next_check = now + self.check_interval
+            self.check()
+        if not self.healthy:
+            return self.primary
+        return self.healthy[next(self.counter) % len(self.healthy)]
+
+
+def make_read_session(router, primary=lambda: False):
+    """Return session registry for read only helpers.
+
+    engine is chosen by router when the session is first used in a
+    request, primary() tells whether this request must see its own
+    writes; call remove() when the request is done.
+    """
+    factory = sessionmaker()
+    return scoped_session(lambda: factory(bind=router.read_engine(primary())))
+
+
+def recount_published(engine):
+    """Rebuild per author and per category published article counters."""
+    articles = models.Article.__table__
+    with engine.begin() as conn:
+        for table, key in ((models.Author.__table__, articles.c.author_id),
+                           (models.Category.__table__, articles.c.category_id)):
+            count = (select(func.count(articles.c.id))
+                     .where(key == table.c.id, articles.c.draft == False)
+                     .scalar_subquery())
+            conn.execute(table.update().values(
+                **models.keep_updated_on(table, article_count=count)))
+
+
+def backfill_excerpts(engine, batch_size=500):
+    """Fill excerpt and word_count of articles saved before they existed.
+
+    runs in short batches so readers are never locked out for long,
+    updated_on is kept as is.
+    """
+    articles = models.Article.__table__
+    update_row = (articles.update()
+                  .where(articles.c.id == bindparam("row_id"))
+                  .values(excerpt=bindparam("excerpt"),
+                          word_count=bindparam("words"),
+                          updated_on=articles.c.updated_on))
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select(articles.c.id, articles.c.article)
+                                .where(articles.c.excerpt == None)
+                                .limit(batch_size)).all()
+            if not rows:
+                break
+            params = []
+            for row_id, article in rows:
+                plain = models.strip_html(article)
+                params.append({"row_id": row_id,
+                               "excerpt": models.make_excerpt(plain),
+                               "words": len(plain.split())})
+            conn.execute(update_row, params)
+
+
+def rerender_articles(engine, workers=None, batch_size=200, missing_only=False,
+                      log=None):
+    """Render sources of articles again into stored html.
+
+    batches are read by id and rendered by a process pool (one process
+    per core when workers is None), at most two batches per process are
+    in flight; results are written in one short transaction per batch
+    and updated_on is kept. Returns number of articles rendered.
+    """
+    articles = models.Article.__table__
+    update_row = (articles.update()
+                  .where(articles.c.id == bindparam("row_id"))
+                  .values(article_html=bindparam("html"),
+                          toc=bindparam("toc_html"),
+                          reading_time=bindparam("minutes"),
+                          excerpt=bindparam("excerpt"),
+                          word_count=bindparam("words"),
+                          updated_on=articles.c.updated_on))
+
+    def batches():
+        last = 0
+        while True:
+            query = select(articles.c.id, articles.c.article,
+                           articles.c.article_format).where(articles.c.id > last)
+            if missing_only:
+                query = query.where(articles.c.article_html == None)
+            with engine.connect() as conn:
+                rows = conn.execute(query.order_by(articles.c.id)
+                                    .limit(batch_size)).all()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [tuple(row) for row in rows]
+
+    def write(results):
+        with engine.begin() as conn:
+            conn.execute(update_row, [
+                {"row_id": row_id, "html": rendered.html, "toc_html": rendered.toc,
+                 "minutes": rendered.reading_time,
+                 "excerpt": models.make_excerpt(rendered.text),
+                 "words": rendered.words}
+                for row_id, rendered in results])
+        if log:
+            log("rendered up to article {}".format(results[-1][0]))
+        return len(results)
+
+    done = 0
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        in_flight = deque()
+        for rows in batches():
+            in_flight.append(pool.submit(markup.render_rows, rows))
+            if len(in_flight) >= 2 * workers:
+                done += write(in_flight.popleft().result())
+        while in_flight:
+            done += write(in_flight.popleft().result())
+    return done
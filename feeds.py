@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Sitemap, RSS and Atom files kept on disk.
+
+files are written by streaming published articles straight from the
+database, nothing is materialized besides the current row. They are
+built on first request after invalidate() and then served as static
+files, so crawlers and feed readers never touch the listing queries.
+Sitemaps past max_urls are split and sitemap.xml becomes an index.
+
+a stamp file next to the feeds records the content generation (shared
+by all worker processes) they were built for, so a worker that starts
+or is recycled reuses them. Stale files keep being served while a
+background thread writes new ones, only the very first build runs in
+the request.
+"""
+
+import os
+import time
+import threading
+from glob import glob
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from bottle import http_date
+from sqlalchemy import select, func
+import models
+
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+ATOM_NS = "http://www.w3.org/2005/Atom"
+DC_NS = "http://purl.org/dc/elements/1.1/"
+STATIC_PAGES = ("/", "/about", "/contact")
+STAMP = "build.stamp"
+
+
+def w3c_date(stamp):
+    return stamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class FeedCache(object):
+    """Generated feed files in directory, rebuilt lazily when stale.
+
+    generation is a callable returning a number that changes whenever
+    articles were written by any process, without it files found on
+    disk are never trusted and built once per process.
+    """
+
+    def __init__(self, read_engine, directory, title, max_urls=50000, entries=20,
+                 chunk=1000, generation=None):
+        self.read_engine = read_engine  # callable returning engine to read from
+        self.directory = directory
+        self.title = title
+        self.max_urls = max_urls
+        self.entries = entries
+        self.chunk = chunk
+        self.generation = generation
+        self.lock = threading.Lock()
+        self.builder = None
+        self.stale = True  # compare with the stamp on disk
+        os.makedirs(directory, exist_ok=True)
+
+    def invalidate(self):
+        self.stale = True
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def stamp(self, base_url):
+        if self.generation is None:
+            return None
+        return "{} {}".format(self.generation(), base_url)
+
+    def built_stamp(self):
+        try:
+            with open(self.path(STAMP), encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def get(self, name, base_url):
+        """Return file name to serve, None when there is no such file."""
+        if self.stale:
+            with self.lock:
+                if self.stale:
+                    self.refresh(base_url)
+        return name if os.path.exists(self.path(name)) else None
+
+    def refresh(self, base_url):
+        stamp = self.stamp(base_url)
+        if stamp is not None and stamp == self.built_stamp():
+            self.stale = False
+            return
+        if self.builder is not None and self.builder.is_alive():
+            return  # stays stale, checked again once the build is done
+        self.stale = False
+        if not os.path.exists(self.path("sitemap.xml")):
+            self.build_stamped(base_url, stamp)  # nothing to serve meanwhile
+            return
+        self.builder = threading.Thread(target=self.build_stamped,
+                                        args=(base_url, stamp), daemon=True)
+        self.builder.start()
+
+    def build_stamped(self, base_url, stamp):
+        try:
+            self.build(base_url)
+        except Exception:
+            self.stale = True
+            raise
+        if stamp is not None:
+            self.write(STAMP, [stamp])
+
+    def build(self, base_url):
+        with self.read_engine().connect() as conn:
+            conn = conn.execution_options(yield_per=self.chunk)
+            self.build_sitemaps(conn, base_url)
+            self.build_rss(conn, base_url)
+            self.build_atom(conn, base_url)
+
+    def published(self, *columns):
+        return select(*columns).where(models.Article.draft == False)
+
+    def write(self, name, lines):
+        """Write lines to name through temporary file, readers (and other
+        worker processes) never see half written file."""
+        tmp = self.path("{}.{:d}.tmp".format(name, os.getpid()))
+        with open(tmp, "w", encoding="utf-8") as f:
+            for number, line in enumerate(lines, 1):
+                f.write(line)
+                if number % self.chunk == 0:
+                    time.sleep(0)  # let requests run, it yields under gevent
+        os.replace(tmp, self.path(name))
+
+    def urls(self, conn, base_url):
+        for path in STATIC_PAGES:
+            yield base_url + path, None
+        query = self.published(models.Article.id, models.Article.created_on,
+                               models.Article.updated_on)
+        for article_id, created_on, updated_on in conn.execute(
+                query.order_by(models.Article.id)):
+            yield ("{}/post/{}".format(base_url, article_id),
+                   updated_on or created_on)
+
+    def urlset(self, urls):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<urlset xmlns="{}">\n'.format(SITEMAP_NS)
+        for loc, lastmod in urls:
+            yield "<url><loc>{}</loc>".format(escape(loc))
+            if lastmod is not None:
+                yield "<lastmod>{}</lastmod>".format(w3c_date(lastmod))
+            yield "</url>\n"
+        yield "</urlset>\n"
+
+    def build_sitemaps(self, conn, base_url):
+        urls = self.urls(conn, base_url)
+        parts = 0
+        while True:
+            part = []
+            for url in urls:
+                part.append(url)
+                if len(part) >= self.max_urls:
+                    break
+            if not part and parts:
+                break
+            parts += 1
+            self.write("sitemap-{}.xml".format(parts), self.urlset(part))
+            if len(part) < self.max_urls:
+                break
+
+        for old in glob(self.path("sitemap-*.xml")):
+            number = os.path.basename(old)[len("sitemap-"):-len(".xml")]
+            if not number.isdigit() or int(number) > parts:
+                os.remove(old)
+        if parts == 1:
+            os.replace(self.path("sitemap-1.xml"), self.path("sitemap.xml"))
+            return
+        now = w3c_date(datetime.utcnow())
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+                 '<sitemapindex xmlns="{}">\n'.format(SITEMAP_NS)]
+        lines += ["<sitemap><loc>{}/sitemap-{}.xml</loc><lastmod>{}</lastmod>"
+                  "</sitemap>\n".format(escape(base_url), i, now)
+                  for i in range(1, parts + 1)]
+        lines.append("</sitemapindex>\n")
+        self.write("sitemap.xml", lines)
+
+    def newest(self, conn):
+        query = self.published(models.Article.id, models.Article.title,
+                               models.Article.excerpt, models.Article.created_on,
+                               models.Article.updated_on, models.Author.username,
+                               models.Category.name)
+        query = query.outerjoin(models.Author,
+                                models.Author.id == models.Article.author_id)
+        query = query.outerjoin(models.Category,
+                                models.Category.id == models.Article.category_id)
+        query = query.order_by(models.Article.created_on.desc(),
+                               models.Article.id.desc())
+        return conn.execute(query.limit(self.entries))
+
+    def build_rss(self, conn, base_url):
+        def lines():
+            yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+            yield ('<rss version="2.0" xmlns:atom="{}" xmlns:dc="{}">'
+                   '<channel>\n').format(ATOM_NS, DC_NS)
+            yield "<title>{}</title><link>{}/</link>".format(escape(self.title),
+                                                              escape(base_url))
+            yield "<description>{}</description>".format(escape(self.title))
+            yield ('<atom:link href="{}/rss.xml" rel="self" '
+                   'type="application/rss+xml"/>\n').format(escape(base_url))
+            for row in self.newest(conn):
+                link = "{}/post/{}".format(base_url, row.id)
+                yield "<item><title>{}</title>".format(escape(row.title or ""))
+                yield "<link>{0}</link><guid>{0}</guid>".format(escape(link))
+                yield "<description>{}</description>".format(escape(row.excerpt or ""))
+                if row.username:
+                    yield "<dc:creator>{}</dc:creator>".format(escape(row.username))
+                if row.name:
+                    yield "<category>{}</category>".format(escape(row.name))
+                if row.created_on:
+                    yield "<pubDate>{}</pubDate>".format(http_date(row.created_on))
+                yield "</item>\n"
+            yield "</channel></rss>\n"
+        self.write("rss.xml", lines())
+
+    def build_atom(self, conn, base_url):
+        updated = conn.execute(self.published(func.max(func.coalesce(
+            models.Article.updated_on, models.Article.created_on)))).scalar()
+
+        def lines():
+            yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+            yield '<feed xmlns="{}">\n'.format(ATOM_NS)
+            yield "<title>{}</title><id>{}/</id>".format(escape(self.title),
+                                                          escape(base_url))
+            yield '<link href="{}/"/>'.format(escape(base_url))
+            yield '<link href="{}/atom.xml" rel="self"/>\n'.format(escape(base_url))
+            yield "<updated>{}</updated>\n".format(w3c_date(updated or datetime.utcnow()))
+            for row in self.newest(conn):
+                link = "{}/post/{}".format(base_url, row.id)
+                yield "<entry><title>{}</title>".format(escape(row.title or ""))
+                yield '<link href="{0}"/><id>{0}</id>'.format(escape(link))
+                yield "<updated>{}</updated>".format(
+                    w3c_date(row.updated_on or row.created_on or datetime.utcnow()))
+                if row.username:
+                    yield "<author><name>{}</name></author>".format(escape(row.username))
+                if row.name:
+                    yield '<category term="{}"/>'.format(escape(row.name, {'"': "&quot;"}))
+                yield "<summary>{}</summary></entry>\n".format(escape(row.excerpt or ""))
+            yield "</feed>\n"
+        self.write("atom.xml", lines())
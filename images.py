@@ -0,0 +1,273 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Uploaded images and their resized variants.
+
+originals are stored under the hash of their content, variants are
+made in a process pool, as decoding and resizing a photo would stall
+every greenlet of the worker for a second. Each width is written as
+WebP and as JPEG for browsers without WebP, never wider than the
+original:
+
+    /media/<digest>.<ext>               original upload
+    /media/<digest>-<width>.<webp|jpg>  variant
+
+names never change their content, so they are served with a year long
+max-age; a variant missing on disk is made again on first request. The
+backgrounds under views/static/img get the same variants, made from
+the static file.
+
+Pillow is needed to accept uploads and make variants, without it
+templates fall back to the original images.
+"""
+
+import os
+import re
+import json
+import hashlib
+import multiprocessing
+from uuid import uuid4
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+MEDIA_URL = "/media"
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp"}
+VARIANT_FORMATS = (("webp", "WEBP"), ("jpg", "JPEG"))
+MEDIA_RE = re.compile(r"^([0-9a-f]{32})(?:-(\d+)\.(webp|jpg)|\.(jpg|png|gif|webp))$")
+MAX_PIXELS = 40 * 1000 * 1000
+
+
+class Timeout(Exception):
+    """Image was not processed within ImageStore.timeout."""
+
+
+def variant_widths(width, widths):
+    """Return widths to make of image width pixels wide, no upscaling."""
+    smaller = [w for w in widths if w < width]
+    if width <= widths[-1]:
+        smaller.append(width)
+    return smaller
+
+
+def variant_name(digest, width, ext):
+    return "{}-{:d}.{}".format(digest, width, ext)
+
+
+def make_variants(source, directory, digest, widths, quality, only=None):
+    """Decode source and write its variants, runs in a pool process.
+
+    only limits the work to one (width, ext) variant, returns size and
+    format of the source; raises ValueError when it is not an image.
+    """
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    try:
+        with Image.open(source) as image:
+            image.verify()
+        image = Image.open(source)
+        image.load()
+    except (OSError, SyntaxError, Image.DecompressionBombError):
+        raise ValueError("not a supported image")
+    if image.format not in EXTENSIONS:
+        raise ValueError("unsupported image format {}".format(image.format))
+
+    source_format = image.format
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info or
+                              image.mode in ("LA", "PA") else "RGB")
+    width, height = image.size
+    for target in variant_widths(width, widths):
+        resized = image
+        if target < width:
+            resized = image.resize((target, max(1, round(height * target / width))),
+                                   Image.LANCZOS)
+        for ext, pil_format in VARIANT_FORMATS:
+            if only is not None and only != (target, ext):
+                continue
+            output = resized
+            if pil_format == "JPEG" and output.mode == "RGBA":
+                output = Image.new("RGB", output.size, (255, 255, 255))
+                output.paste(resized, mask=resized.getchannel("A"))
+            path = os.path.join(directory, variant_name(digest, target, ext))
+            tmp = "{}.{:d}.tmp".format(path, os.getpid())
+            output.save(tmp, pil_format, quality=quality, optimize=True,
+                        progressive=pil_format == "JPEG", method=4)
+            os.replace(tmp, path)
+    return {"width": width, "height": height, "format": source_format}
+
+
+class ImageStore(object):
+    """Content addressed originals and variants in directory.
+
+    metadata of every image (size, where the original is) is kept next
+    to it in <digest>.json, so all worker processes know every image.
+    """
+
+    def __init__(self, directory, static_root="./views/static/img",
+                 widths=(480, 960, 1600, 2400), quality=80, workers=2,
+                 timeout=60):
+        self.directory = directory
+        self.static_root = static_root
+        self.widths = sorted(widths)
+        self.quality = quality
+        self.workers = workers
+        self.timeout = timeout
+        self.meta = {}
+        self.static = {}  # /images/ url -> digest
+        self.pool = None
+        self.pool_pid = None
+        self.pending = {}  # (digest, width, ext) -> future
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def executor(self):
+        """Pool of this process, created on first use (after fork)."""
+        if self.pool is None or self.pool_pid != os.getpid():
+            # spawned workers do not inherit the gevent hub of this process
+            self.pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"))
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def run(self, key, *args):
+        """Run make_variants in the pool, waiting yields to other greenlets;
+        concurrent requests for the same variant share one job. Raises
+        Timeout when it takes longer than timeout."""
+        future = self.pending.get(key)
+        if future is None:
+            future = self.executor().submit(make_variants, *args)
+            self.pending[key] = future
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise Timeout("image processing took too long")
+        finally:
+            self.pending.pop(key, None)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load_meta(self, digest):
+        meta = self.meta.get(digest)
+        if meta is None:
+            try:
+                with open(self.path(digest + ".json")) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self.meta[digest] = meta
+        return meta
+
+    def save_meta(self, digest, meta):
+        tmp = self.path("{}.json.{:d}.tmp".format(digest, os.getpid()))
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.path(digest + ".json"))
+        self.meta[digest] = meta
+
+    def save(self, stream, max_bytes):
+        """Store uploaded image read from stream, returns its url.
+
+        the original is decoded and all its variants made before the url
+        is handed out, raises ValueError for anything but an image.
+        """
+        if not self.available:
+            raise ValueError("image uploads need Pillow")
+        tmp = self.path("upload.{:d}.{}.tmp".format(os.getpid(), uuid4().hex))
+        digest, size = hashlib.sha256(), 0
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in iter(lambda: stream.read(64 * 1024), b""):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError("image is larger than {:d} bytes".format(
+                            max_bytes))
+                    digest.update(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()[:32]
+            meta = self.load_meta(digest)
+            if meta is None:
+                info = self.run((digest, None, None), tmp, self.directory, digest,
+                                self.widths, self.quality)
+                name = digest + EXTENSIONS[info["format"]]
+                os.replace(tmp, self.path(name))
+                meta = dict(info, source=name,
+                            widths=variant_widths(info["width"], self.widths))
+                self.save_meta(digest, meta)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return "{}/{}".format(MEDIA_URL, meta["source"])
+
+    def register_static(self, url):
+        """Return digest of background under static_root, None if missing."""
+        digest = self.static.get(url)
+        if digest is not None:
+            return digest
+        name = url.rsplit("/", 1)[-1]
+        source = os.path.join(self.static_root, name)
+        try:
+            with open(source, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:32]
+            if self.load_meta(digest) is None:
+                with Image.open(source) as image:  # reads the header only
+                    width, height = image.size
+                    source_format = image.format
+                self.save_meta(digest, {
+                    "width": width, "height": height, "format": source_format,
+                    "source": os.path.abspath(source),
+                    "widths": variant_widths(width, self.widths)})
+        except OSError:
+            return None
+        self.static[url] = digest
+        return digest
+
+    def responsive(self, url):
+        """Return src and srcset of WebP and JPEG variants of image at url,
+        None for images not stored here (external urls) or without Pillow."""
+        if not url or not self.available:
+            return None
+        if url.startswith("/images/"):
+            digest = self.register_static(url)
+        else:
+            match = MEDIA_RE.match(url[len(MEDIA_URL) + 1:]) \
+                if url.startswith(MEDIA_URL + "/") else None
+            digest = match.group(1) if match and match.group(4) else None
+        meta = digest and self.load_meta(digest)
+        if not meta:
+            return None
+        widths = meta["widths"]
+        srcset = {ext: ", ".join("{}/{} {:d}w".format(
+            MEDIA_URL, variant_name(digest, w, ext), w) for w in widths)
+            for ext, pil_format in VARIANT_FORMATS}
+        fallback = min(widths, key=lambda w: abs(w - 960))
+        return {"src": "{}/{}".format(MEDIA_URL, variant_name(digest, fallback, "jpg")),
+                "webp": srcset["webp"], "jpeg": srcset["jpg"],
+                "width": meta["width"], "height": meta["height"]}
+
+    def file(self, name):
+        """Return name when it can be served from directory, making a
+        missing variant first; None for unknown files."""
+        match = MEDIA_RE.match(name)
+        if match is None:
+            return None
+        digest, width, ext, original = match.groups()
+        if original or os.path.exists(self.path(name)):
+            return name if os.path.exists(self.path(name)) else None
+        meta = self.load_meta(digest)
+        if meta is None or not self.available or int(width) not in meta["widths"]:
+            return None
+        source = meta["source"]
+        if not os.path.isabs(source):
+            source = self.path(source)
+        self.run((digest, int(width), ext), source, self.directory, digest,
+                 self.widths, self.quality, (int(width), ext))
+        return name
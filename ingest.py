@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Batched background ingestion of contact form submissions.
+
+submissions go to a bounded in-process queue, a background greenlet
+writes them in one transaction per batch, when batch_size rows are
+waiting or flush_interval passed since the first one, so a burst of
+posts costs a few commits instead of one fsync per message.
+"""
+
+import atexit
+import logging
+from collections import deque, defaultdict
+from time import monotonic
+
+import gevent
+from gevent.queue import Queue, Empty
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+import models
+
+log = logging.getLogger("dummyblog.ingest")
+
+
+class RateLimiter(object):
+    """Sliding window limit of events per key (guest ip)."""
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.events = defaultdict(deque)
+
+    def allow(self, key):
+        now = monotonic()
+        events = self.events[key]
+        while events and events[0] <= now - self.period:
+            events.popleft()
+        if len(events) >= self.limit:
+            return False
+        events.append(now)
+        if len(self.events) > 10000:
+            self.prune(now)
+        return True
+
+    def reset(self, key):
+        self.events.pop(key, None)
+
+    def prune(self, now):
+        for key in [k for k, e in self.events.items()
+                    if not e or e[-1] <= now - self.period]:
+            del self.events[key]
+
+
+class ContactQueue(object):
+    """Bounded queue of contact rows flushed in batches."""
+
+    def __init__(self, engine, maxsize=1000, batch_size=100,
+                 flush_interval=1.0, retries=3):
+        self.engine = engine
+        self.queue = Queue(maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.worker = None
+        self.batch = []
+        atexit.register(self.close)
+
+    def put(self, row):
+        """Queue row, raises gevent.queue.Full when there is no room."""
+        if self.worker is None or self.worker.dead:
+            self.worker = gevent.spawn(self.run)
+        self.queue.put_nowait(row)
+
+    def run(self):
+        while True:
+            self.batch = batch = [self.queue.get()]
+            deadline = monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception:
+                # keep flushing, a dead worker would leave the queue full
+                log.exception("dropped %d contact messages: %r", len(batch), batch)
+            self.batch = []
+
+    def write(self, batch):
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(insert(models.Contact), batch)
+                return
+            except SQLAlchemyError:
+                log.exception("contact batch of %d failed, attempt %d",
+                              len(batch), attempt)
+                gevent.sleep(attempt)
+        log.error("dropped %d contact messages: %r", len(batch), batch)
+
+    def drain(self):
+        batch, self.batch = self.batch, []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        for i in range(0, len(batch), self.batch_size):
+            self.write(batch[i:i + self.batch_size])
+
+    def close(self):
+        """Stop worker and write everything still queued."""
+        if self.worker is not None:
+            self.worker.kill()
+            self.worker = None
+        self.drain()
@@ -0,0 +1,272 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Markdown rendering and html sanitizing of articles.
+
+article sources are Markdown, articles written before are html and
+marked so (Article.article_format), those are only sanitized. They are
+rendered once when saved, together with a table of contents and reading
+time, and pages serve the stored html as is.
+
+rendered html is always sanitized: only an allowlist of tags and
+attributes is written back, urls must be http(s), mailto or relative,
+iframes must point to a known video host, and every open tag is closed,
+so a post can neither run script nor break out of the page layout.
+
+Python-Markdown is used when installed, otherwise sources are treated as
+html and only sanitized.
+"""
+
+import re
+from math import ceil
+from html import escape
+from html.parser import HTMLParser
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+try:
+    import markdown
+except ImportError:
+    markdown = None
+
+MARKDOWN = "markdown"
+HTML = "html"
+MARKDOWN_EXTENSIONS = ("extra", "sane_lists")
+WORDS_PER_MINUTE = 230
+TOC_MIN_HEADINGS = 3
+
+ALLOWED_TAGS = {
+    "a", "abbr", "b", "blockquote", "br", "code", "dd", "del", "div", "dl",
+    "dt", "em", "figcaption", "figure", "h1", "h2", "h3", "h4", "h5", "h6",
+    "hr", "i", "iframe", "img", "ins", "kbd", "li", "mark", "ol", "p", "pre",
+    "q", "s", "small", "span", "strong", "sub", "sup", "table", "tbody", "td",
+    "tfoot", "th", "thead", "tr", "u", "ul",
+}
+ALLOWED_ATTRS = {
+    "a": {"href", "title"},
+    "abbr": {"title"},
+    "code": {"class"},
+    "iframe": {"src", "width", "height", "allowfullscreen"},
+    "img": {"src", "alt", "title", "width", "height"},
+    "ol": {"start"},
+    "td": {"colspan", "rowspan"},
+    "th": {"colspan", "rowspan"},
+}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+             "meta", "param", "source", "track", "wbr"}
+DROP_CONTENT = {"script", "style", "template", "noscript", "object", "embed",
+                "textarea", "select", "svg", "math", "head", "title"}
+HEADINGS = {"h1": 1, "h2": 2, "h3": 3}
+SAFE_SCHEMES = {"http", "https", "mailto"}
+IFRAME_HOSTS = {"www.youtube.com", "www.youtube-nocookie.com",
+                "player.vimeo.com"}
+CODE_CLASS_RE = re.compile(r"^language-[\w+-]+$")
+NUMBER_RE = re.compile(r"^\d{1,4}%?$")
+CONTROL_RE = re.compile(r"[\x00-\x20]")
+SLUG_RE = re.compile(r"[^\w\- ]")
+
+Rendered = namedtuple("Rendered", "html toc reading_time words text")
+
+
+def safe_url(url):
+    """Return url when it is relative or of a safe scheme, else None.
+
+    browsers ignore control characters and spaces inside the scheme, so
+    they are removed before looking at it."""
+    compact = CONTROL_RE.sub("", url)
+    scheme, colon, rest = compact.partition(":")
+    if colon and not any(c in scheme for c in "/?#"):
+        if scheme.lower() not in SAFE_SCHEMES:
+            return None
+    return url.strip()
+
+
+def slug(text):
+    return "-".join(SLUG_RE.sub("", text.lower()).split()) or "section"
+
+
+class Sanitizer(HTMLParser):
+    """Rebuild html from allowed tags and attributes only.
+
+    headings get ids and are collected for the table of contents, text
+    is collected for excerpts and word counts."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.text = []
+        self.stack = []
+        self.dropping = None  # tag whose content is left out
+        self.skip = 0  # open tags named like dropping
+        self.heading = None
+        self.headings = []
+        self.ids = set()
+
+    def attributes(self, tag, attrs):
+        allowed = ALLOWED_ATTRS.get(tag, ())
+        result = []
+        for name, value in attrs:
+            if name not in allowed:
+                continue
+            value = value or ""
+            if name in ("href", "src"):
+                value = safe_url(value)
+                if value is None:
+                    continue
+            elif name == "class" and not CODE_CLASS_RE.match(value):
+                continue
+            elif name in ("width", "height", "colspan", "rowspan", "start") \
+                    and not NUMBER_RE.match(value):
+                continue
+            result.append((name, value))
+        return result
+
+    def drop(self, tag):
+        """Leave out tag and everything in it up to its end tag."""
+        if tag not in VOID_TAGS:
+            self.dropping = tag
+            self.skip = 1
+
+    def handle_starttag(self, tag, attrs):
+        if self.dropping is not None:
+            if tag == self.dropping:
+                self.skip += 1
+            return
+        if tag in DROP_CONTENT:
+            self.drop(tag)
+            return
+        if tag not in ALLOWED_TAGS:
+            self.text.append(" ")
+            return
+        attrs = self.attributes(tag, attrs)
+        if tag == "iframe":
+            src = dict(attrs).get("src", "")
+            if src.startswith("//"):  # scheme relative embeds of old posts
+                src = "https:" + src
+                attrs = [(name, src if name == "src" else value)
+                         for name, value in attrs]
+            parts = urlsplit(src)
+            if parts.scheme != "https" or parts.hostname not in IFRAME_HOSTS:
+                self.drop(tag)
+                return
+        if tag == "a" and urlsplit(dict(attrs).get("href", "")).scheme:
+            attrs.append(("rel", "nofollow noopener"))
+        if tag == "img":
+            attrs.append(("loading", "lazy"))
+
+        rendered = "".join(' {}="{}"'.format(name, escape(value))
+                           for name, value in attrs)
+        self.text.append(" ")
+        if tag in VOID_TAGS:
+            self.out.append("<{}{}>".format(tag, rendered))
+            return
+        if tag in HEADINGS and self.heading is None:
+            # id is known only after the text, the tag is written then
+            self.heading = (tag, len(self.out), rendered, [])
+            self.out.append(None)
+        else:
+            self.out.append("<{}{}>".format(tag, rendered))
+        self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.dropping is not None:
+            if tag == self.dropping:
+                self.skip -= 1
+                if not self.skip:
+                    self.dropping = None
+            return
+        if tag not in self.stack:
+            return
+        while self.stack:
+            open_tag = self.stack.pop()
+            self.end(open_tag)
+            if open_tag == tag:
+                break
+
+    def end(self, tag):
+        self.text.append(" ")
+        if self.heading is not None and self.heading[0] == tag:
+            tag, index, rendered, parts = self.heading
+            title = " ".join("".join(parts).split())
+            anchor = base = slug(title)
+            number = 1
+            while anchor in self.ids:
+                number += 1
+                anchor = "{}-{:d}".format(base, number)
+            self.ids.add(anchor)
+            self.out[index] = '<{} id="{}"{}>'.format(tag, anchor, rendered)
+            self.headings.append((HEADINGS[tag], anchor, title))
+            self.heading = None
+        self.out.append("</{}>".format(tag))
+
+    def handle_data(self, data):
+        if self.dropping is not None:
+            return
+        self.out.append(escape(data, quote=False))
+        self.text.append(data)
+        if self.heading is not None:
+            self.heading[3].append(data)
+
+    def close_all(self):
+        self.close()
+        while self.stack:
+            self.end(self.stack.pop())
+
+    def handle_comment(self, data):
+        pass
+
+    def html(self):
+        return "".join(self.out)
+
+    def plain(self):
+        return " ".join("".join(self.text).split())
+
+
+def toc_html(headings):
+    """Return nested list of links to headings, empty for short articles."""
+    if len(headings) < TOC_MIN_HEADINGS:
+        return ""
+    top = min(level for level, anchor, title in headings)
+    out = ['<nav class="toc">']
+    depth = -1
+    for level, anchor, title in headings:
+        level = min(level - top, depth + 1)
+        if level > depth:
+            out.append("<ul><li>")
+        else:
+            out.append("</li>" + "</ul></li>" * (depth - level) + "<li>")
+        depth = level
+        out.append('<a href="#{}">{}</a>'.format(anchor, escape(title)))
+    out.append("</li>" + "</ul></li>" * depth + "</ul></nav>")
+    return "".join(out)
+
+
+def sanitize(html):
+    """Return safe html, its headings and plain text."""
+    sanitizer = Sanitizer()
+    sanitizer.feed(html)
+    sanitizer.close_all()
+    return sanitizer.html(), sanitizer.headings, sanitizer.plain()
+
+
+def render(source, source_format=MARKDOWN):
+    """Render Markdown (or html) source of article into Rendered."""
+    source = source or ""
+    if source_format == MARKDOWN and markdown is not None:
+        source = markdown.markdown(source, extensions=MARKDOWN_EXTENSIONS)
+    html, headings, text = sanitize(source)
+    words = len(text.split())
+    return Rendered(html, toc_html(headings),
+                    ceil(words / WORDS_PER_MINUTE) if words else 0, words, text)
+
+
+def render_rows(rows):
+    """Render (id, source, format) rows, runs in a pool process."""
+    return [(row_id, render(source, source_format or MARKDOWN))
+            for row_id, source, source_format in rows]
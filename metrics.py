@@ -0,0 +1,129 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Per-request SQL and render instrumentation.
+
+Instrumentation hooks engine cursor events and works as a bottle plugin.
+Every request records query count, time spent in the database and in
+templates, which is sent back as Server-Timing header and summed per
+route for /admin/metrics. Statements slower than slow_threshold are
+written to the "dummyblog.slowquery" logger.
+"""
+
+import heapq
+import logging
+import threading
+from functools import wraps
+from time import perf_counter
+from collections import defaultdict
+
+from bottle import response, HTTPResponse
+from sqlalchemy import event
+
+slow_log = logging.getLogger("dummyblog.slowquery")
+
+
+class Instrumentation(object):
+    name = "metrics"
+    api = 2
+
+    def __init__(self, engine, slow_threshold=0.1, keep_slowest=20):
+        self.slow_threshold = slow_threshold
+        self.keep_slowest = keep_slowest
+        self.local = threading.local()  # greenlet local under gevent
+        self.routes = defaultdict(lambda: defaultdict(float))
+        self.slowest = []
+        self.watch(engine)
+
+    def watch(self, engine):
+        """Record statements of engine too (read replicas)."""
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+        event.listen(engine, "after_cursor_execute", self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault("query_started", []).append(perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        duration = perf_counter() - conn.info["query_started"].pop()
+        stats = getattr(self.local, "stats", None)
+        if stats is not None:
+            stats["queries"] += 1
+            stats["db"] += duration
+
+        if duration >= self.slow_threshold:
+            slow_log.warning("%.1fms %s %s %r", duration * 1000,
+                             getattr(self.local, "route", "-"), statement,
+                             parameters)
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, (duration, statement))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, statement))
+
+    def track_render(self, render):
+        """Wrap template render function so its time is recorded."""
+        @wraps(render)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return render(*args, **kwargs)
+            finally:
+                stats = getattr(self.local, "stats", None)
+                if stats is not None:
+                    stats["render"] += perf_counter() - started
+        return wrapper
+
+    def server_timing(self, stats, total):
+        return ('db;dur={:.2f};desc="{:d} queries", render;dur={:.2f}, '
+                'total;dur={:.2f}').format(stats["db"] * 1000,
+                                           int(stats["queries"]),
+                                           stats["render"] * 1000,
+                                           total * 1000)
+
+    def record(self, rule, stats, total):
+        route = self.routes[rule]
+        route["requests"] += 1
+        route["total"] += total
+        for key, value in stats.items():
+            route[key] += value
+
+    def apply(self, callback, route):
+        rule = "{} {}".format(route.method, route.rule)
+
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            self.local.stats = stats = defaultdict(float)
+            self.local.route = rule
+            started = perf_counter()
+            try:
+                body = callback(*args, **kwargs)
+            except HTTPResponse as e:
+                total = perf_counter() - started
+                e.set_header("Server-Timing", self.server_timing(stats, total))
+                self.record(rule, stats, total)
+                raise
+            finally:
+                self.local.stats = None
+            total = perf_counter() - started
+            response.set_header("Server-Timing", self.server_timing(stats, total))
+            self.record(rule, stats, total)
+            return body
+
+        return wrapper
+
+    def summary(self):
+        routes = {}
+        for rule, route in self.routes.items():
+            requests = route["requests"] or 1
+            routes[rule] = {
+                "requests": int(route["requests"]),
+                "avg_ms": route["total"] / requests * 1000,
+                "avg_db_ms": route["db"] / requests * 1000,
+                "avg_render_ms": route["render"] / requests * 1000,
+                "queries_per_request": route["queries"] / requests,
+            }
+        slowest = [{"ms": duration * 1000, "statement": statement}
+                   for duration, statement in sorted(self.slowest, reverse=True)]
+        return {"routes": routes, "slowest": slowest}
@@ -0,0 +1,351 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Versioned schema migrations.
+
+create_all() only creates missing tables, so columns and indexes added
+later never reach an existing database. Every change is a Migration
+with a version number, the version of a database is kept in the
+schema_version table. Steps are idempotent and the version is written
+after a step completes, so an interrupted upgrade is simply run again.
+Backfills run in short batches in their own transactions, with WAL
+readers are never blocked.
+
+a database created before versioning is version 0, an empty one is
+created from models and stamped with the newest version.
+
+    python migrations.py status
+    python migrations.py upgrade
+    python migrations.py downgrade 2
+
+the database url defaults to DUMMYBLOG_DATABASE_URL.
+"""
+
+import argparse
+
+from sqlalchemy import (create_engine, inspect, text, MetaData, Table, Column,
+                        Integer)
+from database import (DATABASE_URL, backfill_excerpts, recount_published,
+                      rerender_articles)
+from search import rebuild_search
+import models
+
+schema_meta = MetaData()
+schema_version = Table("schema_version", schema_meta,
+                       Column("version", Integer(), nullable=False))
+
+
+def has_column(conn, table, column):
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def add_column(conn, table, column, definition):
+    if not has_column(conn, table, column):
+        conn.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+            table, column, definition)))
+
+
+def drop_column(conn, table, column):
+    if has_column(conn, table, column):
+        conn.execute(text("ALTER TABLE {} DROP COLUMN {}".format(table, column)))
+
+
+def create_index(conn, name, table, *columns):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+        name, table, ", ".join(columns))))
+
+
+def drop_index(conn, name):
+    conn.execute(text("DROP INDEX IF EXISTS {}".format(name)))
+
+
+class Migration(object):
+    version = None
+    description = None
+    outside_models = False  # schema models cannot express, run on create too
+
+    def upgrade(self, engine):
+        raise NotImplementedError
+
+    def downgrade(self, engine):
+        raise NotImplementedError
+
+
+class ArticleExcerpts(Migration):
+    version = 1
+    description = "plain text excerpt and word count of articles"
+
+    def upgrade(self, engine):
+        with engine.begin() as conn:
+            add_column(conn, "articles", "excerpt", "VARCHAR(303)")
+            add_column(conn, "articles", "word_count", "INTEGER DEFAULT 0")
+        backfill_excerpts(engine)
+
+    def downgrade(self, engine):
+        with engine.begin() as conn:
+            drop_column(conn, "articles", "word_count")
+            drop_column(conn, "articles", "excerpt")
+
+
+class PublishedCounts(Migration):
+    version = 2
+    description = "denormalized published article counts of authors and categories"
+
+    def upgrade(self, engine):
+        with engine.begin() as conn:
+            add_column(conn, "authors", "article_count", "INTEGER DEFAULT 0")
+            add_column(conn, "category", "article_count", "INTEGER DEFAULT 0")
+        recount_published(engine)
+
+    def downgrade(self, engine):
+        with engine.begin() as conn:
+            drop_column(conn, "category", "article_count")
+            drop_column(conn, "authors", "article_count")
+
+
+HOT_PATH_INDEXES = (
+    ("ix_articles_created_on_id", "articles", ("created_on", "id")),
+    ("ix_articles_author_draft_created", "articles",
+     ("author_id", "draft", "created_on")),
+    ("ix_articles_category_draft_created", "articles",
+     ("category_id", "draft", "created_on")),
+    ("ix_contact_seen_id", "contact", ("seen", "id")),
+    ("ix_authors_session_id", "authors", ("session_id",)),
+)
+
+
+class HotPathIndexes(Migration):
+    version = 3
+    description = "indexes of listings, author/category pages, inbox and sessions"
+
+    def upgrade(self, engine):
+        for name, table, columns in HOT_PATH_INDEXES:
+            with engine.begin() as conn:
+                create_index(conn, name, table, *columns)
+
+    def downgrade(self, engine):
+        with engine.begin() as conn:
+            for name, table, columns in HOT_PATH_INDEXES:
+                drop_index(conn, name)
+
+
+TEXT_INDEXES = (
+    ("ix_articles_title", "articles", "title"),
+    ("ix_articles_subtitle", "articles", "subtitle"),
+    ("ix_articles_article", "articles", "article"),
+)
+
+
+class DropTextIndexes(Migration):
+    version = 4
+    description = "drop b-tree indexes of title, subtitle and body, search uses FTS"
+
+    def upgrade(self, engine):
+        with engine.begin() as conn:
+            for name, table, column in TEXT_INDEXES:
+                drop_index(conn, name)
+
+    def downgrade(self, engine):
+        for name, table, column in TEXT_INDEXES:
+            with engine.begin() as conn:
+                create_index(conn, name, table, column)
+
+
+def add_search_column(conn, body):
+    """Generated tsvector of title, subtitle and html column body."""
+    add_column(conn, "articles", "search",
+               "tsvector GENERATED ALWAYS AS ("
+               "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+               "setweight(to_tsvector('english', coalesce(subtitle, '')), 'B') || "
+               "setweight(to_tsvector('english', regexp_replace("
+               "coalesce({}, ''), '<[^>]*>', ' ', 'g')), 'C')) STORED".format(body))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_articles_search "
+                      "ON articles USING GIN (search)"))
+
+
+def replace_search_column(conn, body):
+    drop_index(conn, "ix_articles_search")
+    drop_column(conn, "articles", "search")
+    add_search_column(conn, body)
+
+
+class PostgresSearch(Migration):
+    """tsvector column for search.PostgresIndex, nothing to do elsewhere.
+
+    databases created from models already have article_html and index it
+    right away, upgraded ones index the source until RenderedArticles."""
+    version = 5
+    description = "generated tsvector search column and GIN index on PostgreSQL"
+    outside_models = True
+
+    def upgrade(self, engine):
+        if engine.dialect.name != "postgresql":
+            return
+        with engine.begin() as conn:
+            rendered = has_column(conn, "articles", "article_html")
+            add_search_column(conn, "article_html" if rendered else "article")
+
+    def downgrade(self, engine):
+        if engine.dialect.name != "postgresql":
+            return
+        with engine.begin() as conn:
+            drop_index(conn, "ix_articles_search")
+            drop_column(conn, "articles", "search")
+
+
+class PasswordHashLength(Migration):
+    """sqlite does not enforce varchar lengths, nothing to do there."""
+    version = 6
+    description = "room for scrypt hashes in authors.password"
+
+    def upgrade(self, engine):
+        if engine.dialect.name != "postgresql":
+            return
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE authors ALTER COLUMN password "
+                              "TYPE VARCHAR(255)"))
+
+    def downgrade(self, engine):
+        if engine.dialect.name != "postgresql":
+            return
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE authors ALTER COLUMN password "
+                              "TYPE VARCHAR(25) USING left(password, 25)"))
+
+
+class RenderedArticles(Migration):
+    version = 7
+    description = "html rendered from Markdown, table of contents, reading time"
+
+    def upgrade(self, engine):
+        with engine.begin() as conn:
+            add_column(conn, "articles", "article_html", "TEXT")
+            add_column(conn, "articles", "toc", "TEXT")
+            add_column(conn, "articles", "reading_time", "INTEGER DEFAULT 0")
+            if not has_column(conn, "articles", "article_format"):
+                # everything written so far is html from the old editor
+                add_column(conn, "articles", "article_format", "VARCHAR(10)")
+                conn.execute(text("UPDATE articles SET article_format = 'html'"))
+        rerender_articles(engine, missing_only=True)
+        # search indexed the sources so far, now it indexes rendered html
+        if engine.dialect.name == "postgresql":
+            with engine.begin() as conn:
+                replace_search_column(conn, "article_html")
+        rebuild_search(engine)
+
+    def downgrade(self, engine):
+        with engine.begin() as conn:
+            if engine.dialect.name == "postgresql":
+                replace_search_column(conn, "article")
+            drop_column(conn, "articles", "article_format")
+            drop_column(conn, "articles", "reading_time")
+            drop_column(conn, "articles", "toc")
+            drop_column(conn, "articles", "article_html")
+
+
+MIGRATIONS = [ArticleExcerpts(), PublishedCounts(), HotPathIndexes(),
+              DropTextIndexes(), PostgresSearch(), PasswordHashLength(),
+              RenderedArticles()]
+HEAD = MIGRATIONS[-1].version
+
+
+def current_version(engine):
+    """Return schema version, 0 for unversioned and None for empty database."""
+    inspector = inspect(engine)
+    if not inspector.has_table("schema_version"):
+        return 0 if inspector.has_table("articles") else None
+    with engine.connect() as conn:
+        return conn.execute(schema_version.select()).scalar() or 0
+
+
+def stamp(engine, version):
+    with engine.begin() as conn:
+        schema_meta.create_all(conn)
+        conn.execute(schema_version.delete())
+        conn.execute(schema_version.insert().values(version=version))
+
+
+def create(engine):
+    """Create schema of empty database from models at newest version."""
+    models.Base.metadata.create_all(engine)
+    for migration in MIGRATIONS:
+        if migration.outside_models:
+            migration.upgrade(engine)
+    stamp(engine, HEAD)
+
+
+def upgrade(engine, target=HEAD, log=None):
+    """Bring database to target version, returns versions applied."""
+    version = current_version(engine)
+    if version is None:
+        create(engine)
+        return [HEAD]
+    applied = []
+    for migration in MIGRATIONS:
+        if version < migration.version <= target:
+            if log:
+                log("upgrade {:d}: {}".format(migration.version,
+                                              migration.description))
+            migration.upgrade(engine)
+            stamp(engine, migration.version)
+            applied.append(migration.version)
+    return applied
+
+
+def downgrade(engine, target, log=None):
+    """Revert migrations newer than target, returns versions reverted."""
+    version = current_version(engine) or 0
+    reverted = []
+    for migration in reversed(MIGRATIONS):
+        if target < migration.version <= version:
+            if log:
+                log("downgrade {:d}: {}".format(migration.version,
+                                                migration.description))
+            migration.downgrade(engine)
+            stamp(engine, migration.version - 1)
+            reverted.append(migration.version)
+    return reverted
+
+
+def check(engine):
+    """Raise SystemExit unless database is at the newest version."""
+    version = current_version(engine)
+    if version != HEAD:
+        raise SystemExit("database schema is at version {}, expected {}; "
+                         "run: python migrations.py upgrade".format(version, HEAD))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="database schema migrations")
+    parser.add_argument("--db", default=DATABASE_URL,
+                        help="database url")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="show current and available versions")
+    upgrade_parser = commands.add_parser("upgrade", help="apply migrations")
+    upgrade_parser.add_argument("version", type=int, nargs="?", default=HEAD)
+    downgrade_parser = commands.add_parser("downgrade", help="revert migrations")
+    downgrade_parser.add_argument("version", type=int)
+    args = parser.parse_args()
+
+    engine = create_engine(args.db)
+    if args.command == "status":
+        version = current_version(engine)
+        for migration in MIGRATIONS:
+            applied = version is not None and migration.version <= version
+            print("{} {:d} {}".format("*" if applied else " ", migration.version,
+                                      migration.description))
+        print("current: {}, head: {:d}".format(version, HEAD))
+    elif args.command == "upgrade":
+        applied = upgrade(engine, args.version, log=print)
+        print("at version {}".format(current_version(engine)) if applied
+              else "nothing to upgrade")
+    else:
+        reverted = downgrade(engine, args.version, log=print)
+        print("at version {}".format(current_version(engine)) if reverted
+              else "nothing to downgrade")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,28 +3,70 @@
 # vim:fenc=utf-8
 
 
+import re
+from html import unescape
 from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import (Column, Integer, String,
-                        DateTime, ForeignKey, Boolean, Sequence)
+from sqlalchemy.orm import deferred, validates
+from sqlalchemy import (Column, Integer, String, DateTime, ForeignKey,
+                        Boolean, Sequence, Index, event, inspect, func)
+import markup
 
 Base = declarative_base()
 
+TAG_RE = re.compile(r"<[^>]*>")
+EXCERPT_LENGTH = 300
+
+
+def strip_html(html):
+    """Return plain text of article body."""
+    return " ".join(unescape(TAG_RE.sub(" ", html or "")).split())
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(" ", 1)[0] + "..."
+
 
 class Article(Base):
     __tablename__ = "articles"
 
     id = Column(Integer(), Sequence("articles_id_seq"), primary_key=True)
-    title = Column(String(1000), index=True)
-    subtitle = Column(String(500), index=True)
+    title = Column(String(1000))
+    subtitle = Column(String(500))
     header_image = Column(String(500))
-    article = Column(String(), index=True)
+    article = deferred(Column(String()))  # Markdown source, html for old posts
+    article_format = Column(String(10), default=markup.MARKDOWN)
+    article_html = deferred(Column(String()))
+    toc = deferred(Column(String()))
+    reading_time = Column(Integer(), default=0)
+    excerpt = Column(String(EXCERPT_LENGTH + 3))
+    word_count = Column(Integer(), default=0)
     draft = Column(Boolean(), default=False)
     category_id = Column(Integer(), ForeignKey("category.id"), default=1)
     author_id = Column(Integer(), ForeignKey("authors.id"))
     created_on = Column(DateTime(), default=datetime.now)
     updated_on = Column(DateTime(), default=datetime.now, onupdate=datetime.now)
 
+    __table_args__ = (
+        Index("ix_articles_created_on_id", "created_on", "id"),
+        Index("ix_articles_author_draft_created", "author_id", "draft",
+              "created_on"),
+        Index("ix_articles_category_draft_created", "category_id", "draft",
+              "created_on"),
+    )
+
+    @validates("article")
+    def render(self, key, article):
+        """Render source once on save, reads use the stored html."""
+        rendered = markup.render(article, self.article_format or markup.MARKDOWN)
+        self.article_html = rendered.html
+        self.toc = rendered.toc
+        self.reading_time = rendered.reading_time
+        self.excerpt = make_excerpt(rendered.text)
+        self.word_count = rendered.words
+        return article
 
     def __repr__(self):
         return "Article(title='{self.title}', " \
@@ -39,9 +81,10 @@ class Author(Base):
     username = Column(String(15), nullable=False, unique=True)
     firstname = Column(String(15), nullable=False)
     lastname = Column(String(15), nullable=False)
-    password = Column(String(25), nullable=False)
+    password = Column(String(255), nullable=False)
     email = Column(String(255), nullable=False, unique=True)
-    session_id = Column(String(36))
+    session_id = Column(String(36), index=True)
+    article_count = Column(Integer(), default=0)  # published articles
     created_on = Column(DateTime(), default=datetime.now)
     updated_on = Column(DateTime(), default=datetime.now, onupdate=datetime.now)
 
@@ -54,6 +97,7 @@ class Category(Base):
 
     id = Column(Integer(), primary_key=True)
     name = Column(String(255), nullable=False, unique=True)
+    article_count = Column(Integer(), default=0)  # published articles
     created_on = Column(DateTime(), default=datetime.now)
 
     def __repr__(self):
@@ -72,6 +116,10 @@ class Contact(Base):
     seen = Column(Boolean(), default=False)
     created_on = Column(DateTime(), default=datetime.now)
 
+    __table_args__ = (
+        Index("ix_contact_seen_id", "seen", "id"),
+    )
+
     def __repr__(self):
         return "subject(user_id={self.subject}, " \
             "message={self.message})".format(self=self)
@@ -87,3 +135,53 @@ class Settings(Base):
     def __repr__(self):
         return "Settings(site_name={self.site_name}, " \
             "site_subname={self.site_subname})".format(self=self)
+
+
+def keep_updated_on(table, **values):
+    """Counter writes are not edits, do not let onupdate bump updated_on."""
+    if "updated_on" in table.c:
+        values["updated_on"] = table.c.updated_on
+    return values
+
+
+def count_published(conn, author_id, category_id, delta):
+    for table, row_id in ((Author.__table__, author_id),
+                          (Category.__table__, category_id)):
+        if row_id is not None:
+            count = func.coalesce(table.c.article_count, 0) + delta
+            conn.execute(table.update().where(table.c.id == row_id)
+                         .values(**keep_updated_on(table, article_count=count)))
+
+
+def previous(state, key):
+    history = state.attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.obj(), key)
+
+
+@event.listens_for(Article, "after_insert")
+def article_inserted(mapper, conn, target):
+    if not target.draft:
+        count_published(conn, target.author_id, target.category_id, 1)
+
+
+@event.listens_for(Article, "after_update")
+def article_updated(mapper, conn, target):
+    """Move published counters on publish, unpublish or reassignment."""
+    state = inspect(target)
+    before = (not previous(state, "draft"), previous(state, "author_id"),
+              previous(state, "category_id"))
+    after = (not target.draft, target.author_id, target.category_id)
+    if before == after:
+        return
+    if before[0]:
+        count_published(conn, before[1], before[2], -1)
+    if after[0]:
+        count_published(conn, after[1], after[2], 1)
+
+
+@event.listens_for(Article, "after_delete")
+def article_deleted(mapper, conn, target):
+    if not target.draft:
+        count_published(conn, target.author_id, target.category_id, -1)
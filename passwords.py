@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Password hashing off the event loop.
+
+passwords are hashed with scrypt from hashlib and stored as
+
+    scrypt$<n>$<r>$<p>$<salt>$<key>
+
+salt and key in base64. Deriving a key costs ~100ms of CPU and 32MB,
+done inline it would stall every greenlet of the process, so it runs
+in a small pool of native threads (hashlib releases the GIL) and only
+the requesting greenlet waits. When more hashes are waiting than the
+pool can work off quickly, new ones are refused with Busy instead of
+queueing up behind a brute force burst.
+
+hashes made by crypt() before are still accepted; verify() then tells
+the caller to store a new hash.
+"""
+
+import os
+import hmac
+import base64
+import hashlib
+
+from gevent.threadpool import ThreadPool
+
+try:
+    from crypt import crypt
+except ImportError:  # removed in Python 3.13
+    crypt = None
+
+PREFIX = "scrypt"
+N, R, P = 2 ** 15, 8, 1  # 32MB per hash
+
+
+class Busy(Exception):
+    """Too many hashes waiting for the pool."""
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def b64decode(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def derive(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * n, dklen=32)
+
+
+def encode(password, salt, n, r, p):
+    return "$".join((PREFIX, str(n), str(r), str(p), b64encode(salt),
+                     b64encode(derive(password, salt, n, r, p))))
+
+
+def check(password, stored, n, r, p):
+    """Compare password to stored hash, returns (match, needs_rehash)."""
+    if stored.startswith(PREFIX + "$"):
+        try:
+            prefix, sn, sr, sp, salt, key = stored.split("$")
+            sn, sr, sp = int(sn), int(sr), int(sp)
+            salt, key = b64decode(salt), b64decode(key)
+        except ValueError:
+            return False, False
+        match = hmac.compare_digest(derive(password, salt, sn, sr, sp), key)
+        return match, match and (sn, sr, sp) != (n, r, p)
+    if crypt is None or not stored:
+        return False, False
+    legacy = crypt(password, stored) or ""
+    match = hmac.compare_digest(legacy.encode("utf-8"), stored.encode("utf-8"))
+    return match, match
+
+
+class PasswordHasher(object):
+    """Hash and verify passwords in a bounded thread pool.
+
+    raising n (cost) later is fine, older hashes are verified with their
+    own parameters and replaced on the next login.
+    """
+
+    def __init__(self, workers=2, max_pending=16, n=N, r=R, p=P,
+                 salt_size=16):
+        self.pool = ThreadPool(workers)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.n = n
+        self.r = r
+        self.p = p
+        self.salt_size = salt_size
+        self.dummy = None
+
+    def apply(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise Busy()
+        self.pending += 1
+        try:
+            return self.pool.apply(func, args)
+        finally:
+            self.pending -= 1
+
+    def hash(self, password):
+        return self.apply(encode, password, os.urandom(self.salt_size),
+                          self.n, self.r, self.p)
+
+    def verify(self, password, stored):
+        """Return (match, needs_rehash) of password against stored hash.
+
+        unknown users are checked against a dummy hash (pass None), so
+        they take as long as known ones.
+        """
+        if stored is None:
+            if self.dummy is None:
+                self.dummy = self.hash("")
+            self.apply(check, password, self.dummy, self.n, self.r, self.p)
+            return False, False
+        return self.apply(check, password, stored, self.n, self.r, self.p)
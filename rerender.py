@@ -0,0 +1,51 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Render stored article sources again.
+
+articles are rendered when saved; run this after changing the renderer
+or the sanitizer allowlist in markup.py. Work is spread over a process
+pool, one process per core by default.
+
+    python rerender.py
+    python rerender.py --missing --workers 4
+
+the database url defaults to DUMMYBLOG_DATABASE_URL, caches of a running
+app are not invalidated, restart it afterwards.
+"""
+
+import sys
+import argparse
+
+from sqlalchemy import create_engine
+from database import DATABASE_URL, rerender_articles
+from search import rebuild_search
+import migrations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="render articles again")
+    parser.add_argument("--db", default=DATABASE_URL,
+                        help="database url")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="render processes, default one per core")
+    parser.add_argument("--batch-size", type=int, default=200,
+                        help="articles per batch")
+    parser.add_argument("--missing", action="store_true",
+                        help="only articles never rendered")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db)
+    migrations.check(engine)
+    count = rerender_articles(engine, workers=args.workers,
+                              batch_size=args.batch_size,
+                              missing_only=args.missing,
+                              log=lambda line: print(line, file=sys.stderr))
+    rebuild_search(engine)
+    print("rendered {} articles".format(count))
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
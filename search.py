@@ -0,0 +1,377 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Full-text search over articles.
+
+PostgreSQL uses the tsvector column added by migration 5, SQLite FTS5
+is used when the sqlite library has it compiled in, otherwise an
+in-memory inverted index is built at startup. The latter two are kept in
+sync with models.Article through mapper events, so the rest of the app
+only calls search() and count(). All of them index the plain text of
+the rendered article_html, not the Markdown source.
+"""
+
+import re
+from html import escape, unescape
+from math import log
+from collections import defaultdict
+
+from sqlalchemy import event, text, inspect, select, bindparam
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, object_session
+import models
+from models import strip_html
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+SNIPPET_WORDS = 24
+INDEXED = ("title", "subtitle", "article_html", "author_id", "draft")
+
+
+def tokenize(value):
+    return TOKEN_RE.findall(value.lower())
+
+
+def highlight(snippet):
+    """Escape snippet and turn highlight markers into <mark> tags."""
+    snippet = escape(snippet)
+    snippet = snippet.replace(HIGHLIGHT_START, "<mark>")
+    return snippet.replace(HIGHLIGHT_END, "</mark>")
+
+
+def make_snippet(value, terms, words=SNIPPET_WORDS):
+    """Cut a window of words around the first matching term."""
+    value = value.split()
+    first = 0
+    for i, word in enumerate(value):
+        if any(t in terms for t in tokenize(word)):
+            first = i
+            break
+    start = max(first - words // 4, 0)
+    window = value[start:start + words]
+    for i, word in enumerate(window):
+        if any(t in terms for t in tokenize(word)):
+            window[i] = HIGHLIGHT_START + word + HIGHLIGHT_END
+    snippet = " ".join(window)
+    if start > 0:
+        snippet = "..." + snippet
+    if start + words < len(value):
+        snippet += "..."
+    return snippet
+
+
+def changed(target, keys=INDEXED):
+    state = inspect(target)
+    return any(state.attrs[key].history.has_changes() for key in keys)
+
+
+def article_body(conn, target):
+    """Return html of target, read on the flush connection when deferred."""
+    if "article_html" in inspect(target).unloaded:
+        query = select(models.Article.article_html).where(
+            models.Article.id == target.id)
+        return conn.execute(query).scalar()
+    return target.article_html
+
+
+class FTS5Index(object):
+    """Search backed by SQLite FTS5 virtual table.
+
+    rows are stored with rowid equal to article id and the rendered body
+    stripped of html, ranking is bm25 via FTS5 rank column.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def setup(self):
+        with self.engine.begin() as conn:
+            exists = conn.execute(text("SELECT name FROM sqlite_master "
+                                       "WHERE name = 'articles_fts'")).first()
+            if exists is None:
+                conn.execute(text("CREATE VIRTUAL TABLE articles_fts USING "
+                                  "fts5(title, subtitle, article, "
+                                  "tokenize = 'porter unicode61')"))
+                self.rebuild(conn)
+
+    def rebuild(self, conn):
+        conn.execute(text("DELETE FROM articles_fts"))
+        query = conn.execute(text("SELECT id, title, subtitle, article_html "
+                                  "FROM articles"))
+        for row in query:
+            self.add(conn, row[0], row[1], row[2], row[3])
+
+    def add(self, conn, article_id, title, subtitle, article):
+        conn.execute(text("INSERT INTO articles_fts(rowid, title, subtitle, article) "
+                          "VALUES (:id, :title, :subtitle, :article)"),
+                     {"id": article_id, "title": title or "",
+                      "subtitle": subtitle or "", "article": strip_html(article)})
+
+    def remove(self, conn, article_id):
+        conn.execute(text("DELETE FROM articles_fts WHERE rowid = :id"),
+                     {"id": article_id})
+
+    def refresh(self):
+        pass  # the table is shared, every process writes to it
+
+    def on_insert(self, mapper, conn, target):
+        self.add(conn, target.id, target.title, target.subtitle,
+                 article_body(conn, target))
+
+    def on_update(self, mapper, conn, target):
+        if not changed(target, ("title", "subtitle", "article_html")):
+            return
+        self.remove(conn, target.id)
+        self.add(conn, target.id, target.title, target.subtitle,
+                 article_body(conn, target))
+
+    def on_delete(self, mapper, conn, target):
+        self.remove(conn, target.id)
+
+    @staticmethod
+    def match_expression(query):
+        """Quote every token so user input is never parsed as FTS syntax."""
+        return " ".join('"' + t + '"' for t in tokenize(query))
+
+    def _filtered(self, columns, author):
+        sql = ("SELECT " + columns + " FROM articles_fts "
+               "JOIN articles ON articles.id = articles_fts.rowid "
+               "WHERE articles_fts MATCH :match AND articles.draft = 0")
+        if author:
+            sql += " AND articles.author_id = :author"
+        return sql
+
+    def search(self, session, query, author=None, offset=0, limit=10):
+        """Return list of (article_id, snippet html) ordered by rank."""
+        match = self.match_expression(query)
+        if not match:
+            return []
+        sql = self._filtered("articles.id, snippet(articles_fts, 2, :hs, :he, "
+                             "'...', :words)", author)
+        sql += " ORDER BY articles_fts.rank LIMIT :limit OFFSET :offset"
+        rows = session.execute(text(sql), {"match": match, "author": author,
+                                           "hs": HIGHLIGHT_START,
+                                           "he": HIGHLIGHT_END,
+                                           "words": SNIPPET_WORDS,
+                                           "limit": limit, "offset": offset})
+        return [(row[0], highlight(row[1])) for row in rows]
+
+    def count(self, session, query, author=None):
+        match = self.match_expression(query)
+        if not match:
+            return 0
+        sql = self._filtered("count(*)", author)
+        return session.execute(text(sql), {"match": match,
+                                           "author": author}).scalar()
+
+
+class InvertedIndex(object):
+    """Pure python fallback used when FTS5 is not available.
+
+    postings map token -> {article_id: term frequency}, docs keep
+    (author_id, draft) so published filter does not need the database.
+    Changes are staged on flush and applied after commit. Writes of other
+    processes are picked up by refresh(), which reloads articles whose
+    updated_on differs from the one indexed.
+    """
+
+    def __init__(self, engine, chunk=500):
+        self.engine = engine
+        self.chunk = chunk
+        self.postings = defaultdict(dict)
+        self.terms = {}
+        self.docs = {}
+        self.stamps = {}  # article_id -> updated_on indexed
+
+    def setup(self):
+        self.refresh()
+
+    def refresh(self):
+        with self.engine.connect() as conn:
+            stamps = dict(conn.execute(text("SELECT id, updated_on "
+                                            "FROM articles")).all())
+            for article_id in set(self.docs) - stamps.keys():
+                self.remove(article_id)
+            changed = [article_id for article_id, stamp in stamps.items()
+                       if self.stamps.get(article_id) != stamp
+                       or article_id not in self.docs]
+            for i in range(0, len(changed), self.chunk):
+                query = conn.execute(
+                    text("SELECT id, title, subtitle, article_html, author_id, "
+                         "draft, updated_on FROM articles WHERE id IN :ids")
+                    .bindparams(bindparam("ids", expanding=True)),
+                    {"ids": changed[i:i + self.chunk]})
+                for row in query:
+                    self.add(row[0], row[1], row[2], row[3], row[4], row[5])
+                    self.stamps[row[0]] = row[6]
+
+    def add(self, article_id, title, subtitle, article, author_id, draft):
+        self.remove(article_id)
+        counts = defaultdict(int)
+        for field in (title, subtitle, strip_html(article)):
+            for token in tokenize(field or ""):
+                counts[token] += 1
+        for token, tf in counts.items():
+            self.postings[token][article_id] = tf
+        self.terms[article_id] = list(counts)
+        self.docs[article_id] = (author_id, bool(draft))
+        self.stamps.pop(article_id, None)  # reloaded by the next refresh
+
+    def remove(self, article_id):
+        for token in self.terms.pop(article_id, ()):
+            postings = self.postings[token]
+            postings.pop(article_id, None)
+            if not postings:
+                del self.postings[token]
+        self.docs.pop(article_id, None)
+        self.stamps.pop(article_id, None)
+
+    def _stage(self, target, change):
+        session = object_session(target)
+        session.info.setdefault("search_pending", []).append(change)
+
+    def on_insert(self, mapper, conn, target):
+        self._stage(target, ("add", target.id, target.title, target.subtitle,
+                             article_body(conn, target), target.author_id,
+                             target.draft))
+
+    def on_update(self, mapper, conn, target):
+        if changed(target):
+            self.on_insert(mapper, conn, target)
+
+    def on_delete(self, mapper, conn, target):
+        self._stage(target, ("remove", target.id))
+
+    def on_commit(self, session):
+        for change in session.info.pop("search_pending", ()):
+            if change[0] == "add":
+                self.add(*change[1:])
+            else:
+                self.remove(change[1])
+
+    def on_rollback(self, session):
+        session.info.pop("search_pending", None)
+
+    def _matches(self, query, author):
+        tokens = tokenize(query)
+        if not tokens:
+            return {}
+        postings = [self.postings.get(t, {}) for t in tokens]
+        postings.sort(key=len)
+        found = set(postings[0])
+        for p in postings[1:]:
+            found &= p.keys()
+        total = len(self.docs) or 1
+        scores = {}
+        for article_id in found:
+            author_id, draft = self.docs[article_id]
+            if draft or (author and str(author_id) != str(author)):
+                continue
+            scores[article_id] = sum(p[article_id] * log(1 + total / len(p))
+                                     for p in postings)
+        return scores
+
+    def search(self, session, query, author=None, offset=0, limit=10):
+        scores = self._matches(query, author)
+        ranked = sorted(scores, key=lambda i: (-scores[i], -i))
+        ranked = ranked[offset:offset + limit]
+        if not ranked:
+            return []
+        bodies = session.query(models.Article.id, models.Article.article_html)
+        bodies = dict(bodies.filter(models.Article.id.in_(ranked)).all())
+        terms = set(tokenize(query))
+        return [(i, highlight(make_snippet(strip_html(bodies.get(i)), terms)))
+                for i in ranked]
+
+    def count(self, session, query, author=None):
+        return len(self._matches(query, author))
+
+
+class PostgresIndex(object):
+    """Search backed by generated tsvector column articles.search.
+
+    the column and its GIN index are kept by PostgreSQL itself, ranking
+    is ts_rank and snippets come from ts_headline.
+    """
+
+    def __init__(self, engine, config="english"):
+        self.engine = engine
+        self.config = config
+
+    def setup(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def _filtered(self, columns, author):
+        sql = ("SELECT " + columns + " FROM articles, "
+               "plainto_tsquery(CAST(:config AS regconfig), :query) AS query "
+               "WHERE articles.search @@ query AND NOT articles.draft")
+        if author:
+            sql += " AND articles.author_id = :author"
+        return sql
+
+    def search(self, session, query, author=None, offset=0, limit=10):
+        if not tokenize(query):
+            return []
+        sql = self._filtered("articles.id, ts_headline(CAST(:config AS regconfig), "
+                             "regexp_replace(articles.article_html, '<[^>]*>', ' ', 'g'), "
+                             "query, :options)", author)
+        sql += (" ORDER BY ts_rank(articles.search, query) DESC, articles.id DESC "
+                "LIMIT :limit OFFSET :offset")
+        options = "StartSel={}, StopSel={}, MaxWords={:d}, MinWords={:d}".format(
+            HIGHLIGHT_START, HIGHLIGHT_END, SNIPPET_WORDS, SNIPPET_WORDS // 2)
+        rows = session.execute(text(sql), {"config": self.config, "query": query,
+                                           "author": int(author or 0),
+                                           "options": options, "limit": limit,
+                                           "offset": offset})
+        return [(row[0], highlight(unescape(row[1]))) for row in rows]
+
+    def count(self, session, query, author=None):
+        if not tokenize(query):
+            return 0
+        sql = self._filtered("count(*)", author)
+        return session.execute(text(sql), {"config": self.config, "query": query,
+                                           "author": int(author or 0)}).scalar()
+
+
+def rebuild_search(engine):
+    """Refresh FTS table, bulk writes bypass the mapper events keeping it."""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT name FROM sqlite_master "
+                                   "WHERE name = 'articles_fts'")).first()
+        if exists is not None:
+            FTS5Index(engine).rebuild(conn)
+
+
+def fts5_available(engine):
+    with engine.connect() as conn:
+        try:
+            conn.execute(text("CREATE VIRTUAL TABLE temp.fts5_probe "
+                              "USING fts5(x)"))
+            conn.execute(text("DROP TABLE temp.fts5_probe"))
+        except OperationalError:
+            return False
+    return True
+
+
+def create_index(engine):
+    """Build the search index for engine and hook it to Article writes."""
+    if engine.dialect.name == "postgresql":
+        return PostgresIndex(engine)
+    if engine.dialect.name == "sqlite" and fts5_available(engine):
+        index = FTS5Index(engine)
+    else:
+        index = InvertedIndex(engine)
+        event.listen(Session, "after_commit", index.on_commit)
+        event.listen(Session, "after_rollback", index.on_rollback)
+    index.setup()
+    event.listen(models.Article, "after_insert", index.on_insert)
+    event.listen(models.Article, "after_update", index.on_update)
+    event.listen(models.Article, "after_delete", index.on_delete)
+    return index
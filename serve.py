@@ -0,0 +1,277 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Pre-fork production launcher.
+
+the master binds the listening socket and forks gevent workers which
+all accept on it; each worker imports the app after fork so it opens
+its own database pools. The master itself never imports app modules,
+checks before (re)starting run in a short-lived child, so a reload
+really runs the new code. Pages and sessions are cached in a sqlite file
+shared by all workers (DUMMYBLOG_SHARED_CACHE).
+
+workers are recycled after max_requests requests (with jitter, so they
+do not restart together) or when their RSS grows past max_rss_mb; they
+stop accepting, finish requests in flight and exit, the master forks a
+replacement.
+
+signals to the master:
+    HUP           graceful reload, new workers with fresh code, old ones
+                  drain and exit
+    TERM, INT     graceful shutdown
+    TTIN, TTOU    one worker more or less
+
+    python serve.py --host 0.0.0.0 --port 8080 --workers 4
+"""
+
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+import argparse
+import resource
+import traceback
+
+
+def current_rss_mb():
+    """Resident set size of this process, peak RSS where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024.0 / 1024.0
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Worker(object):
+    """Runs inside forked child, serves until recycled or told to stop."""
+
+    def __init__(self, listener, max_requests, max_rss_mb, graceful_timeout,
+                 connections):
+        self.listener = listener
+        self.max_requests = max_requests
+        self.max_rss_mb = max_rss_mb
+        self.graceful_timeout = graceful_timeout
+        self.connections = connections
+        self.requests = 0
+        self.server = None
+
+    def app(self, wsgi):
+        def counted(environ, start_response):
+            self.requests += 1
+            try:
+                return wsgi(environ, start_response)
+            finally:
+                if self.should_recycle():
+                    self.stop()
+        return counted
+
+    def should_recycle(self):
+        if self.max_requests and self.requests >= self.max_requests:
+            return True
+        return bool(self.max_rss_mb) and current_rss_mb() > self.max_rss_mb
+
+    def stop(self):
+        """Stop accepting, other workers take over; serve_forever() then
+        waits up to graceful_timeout for requests in flight."""
+        if self.server is not None and not self.server.closed:
+            self.server.close()
+
+    def run(self):
+        import app as blog  # patches stdlib for gevent, opens pools
+        import bottle
+        import gevent
+        from gevent import socket as gsocket
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+
+        listener = gsocket.socket(fileno=os.dup(self.listener.fileno()))
+        self.listener.close()
+        # handlers run in a pool, so stopping can wait for them to finish
+        self.server = WSGIServer(listener, self.app(bottle.default_app()),
+                                 spawn=Pool(self.connections), log=None)
+        gevent.signal_handler(signal.SIGTERM, self.stop)
+        gevent.signal_handler(signal.SIGINT, self.stop)
+        self.server.serve_forever(stop_timeout=self.graceful_timeout)
+        blog.contact_queue.close()
+
+
+def prepare(shared_cache):
+    """Checks before starting workers, runs in a child of the master."""
+    from cache import SharedPageCache, SharedTTLCache
+    from database import make_engine, DATABASE_URL
+    import migrations
+    import search
+
+    engine = make_engine(DATABASE_URL)
+    migrations.check(engine)
+    if engine.dialect.name == "sqlite" and search.fts5_available(engine):
+        search.FTS5Index(engine).setup()
+    engine.dispose()
+    SharedPageCache(shared_cache, 0).clear()
+    SharedTTLCache(shared_cache, 0, name="auth").clear()
+
+
+class Master(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.workers = {}  # pid -> generation
+        self.generation = 0
+        self.target = args.workers
+        self.signals = []
+        self.listener = None
+
+    def bind(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.args.host, self.args.port))
+        listener.listen(self.args.backlog)
+        listener.set_inheritable(True)
+        return listener
+
+    def fork(self, target, *args):
+        """Run target in a child process, returns its pid."""
+        pid = os.fork()
+        if pid:
+            return pid
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                    signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(sig, signal.SIG_DFL)
+        code = 0
+        try:
+            target(*args)
+        except SystemExit as e:
+            if e.code:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def prepare(self):
+        """Check the schema, create the search index once instead of in
+        every worker at the same time, and drop pages rendered by
+        previous code; returns False when the checks failed."""
+        _, status = os.waitpid(self.fork(prepare, self.args.shared_cache), 0)
+        return os.waitstatus_to_exitcode(status) == 0
+
+    def spawn(self):
+        jitter = random.randint(0, self.args.max_requests_jitter)
+        max_requests = self.args.max_requests + jitter if self.args.max_requests else 0
+        worker = Worker(self.listener, max_requests, self.args.max_rss_mb,
+                        self.args.graceful_timeout, self.args.connections)
+        self.workers[self.fork(worker.run)] = self.generation
+
+    def kill(self, pid, sig=signal.SIGTERM):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def on_signal(self, sig, frame):
+        self.signals.append(sig)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.workers.pop(pid, None)
+
+    def handle(self, sig):
+        if sig == signal.SIGHUP:
+            print("reloading", file=sys.stderr)
+            if not self.prepare():
+                print("reload failed, keeping workers", file=sys.stderr)
+                return True
+            old = list(self.workers)
+            self.generation += 1
+            for _ in range(self.target):
+                self.spawn()
+            for pid in old:
+                self.kill(pid)
+        elif sig == signal.SIGTTIN:
+            self.target += 1
+        elif sig == signal.SIGTTOU:
+            self.target = max(self.target - 1, 1)
+        else:
+            return False
+        return True
+
+    def run(self):
+        if not self.prepare():
+            sys.exit(1)
+        self.listener = self.bind()
+        os.environ["DUMMYBLOG_SHARED_CACHE"] = self.args.shared_cache
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                    signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(sig, self.on_signal)
+        print("listening on {}:{:d} with {:d} workers".format(
+            self.args.host, self.args.port, self.target), file=sys.stderr)
+
+        running = True
+        while running:
+            while self.signals:
+                sig = self.signals.pop(0)
+                if sig in (signal.SIGTERM, signal.SIGINT):
+                    running = False
+                elif sig != signal.SIGCHLD:
+                    self.handle(sig)
+            self.reap()
+            if not running:
+                break
+            current = [pid for pid, gen in self.workers.items()
+                       if gen == self.generation]
+            for _ in range(self.target - len(current)):
+                self.spawn()
+            for pid in current[self.target:]:
+                self.kill(pid)
+            time.sleep(0.5)
+
+        print("shutting down", file=sys.stderr)
+        for pid in list(self.workers):
+            self.kill(pid)
+        deadline = time.monotonic() + self.args.graceful_timeout + 1
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGKILL)
+        self.listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pre-fork gevent launcher")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--connections", type=int, default=1000,
+                        help="concurrent connections per worker")
+    parser.add_argument("--max-requests", type=int, default=10000,
+                        help="recycle worker after this many requests, 0 never")
+    parser.add_argument("--max-requests-jitter", type=int, default=1000)
+    parser.add_argument("--max-rss-mb", type=int, default=512,
+                        help="recycle worker above this RSS, 0 never")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0,
+                        help="seconds workers get to finish requests in flight")
+    parser.add_argument("--shared-cache", default="./shared_cache.db",
+                        help="sqlite file of cache shared by workers")
+    Master(parser.parse_args()).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Precompiled template registry.
+
+every .html file under views/ (static assets excluded) is compiled once
+at startup and registered under the same name the app and includes use,
+e.g. "./views/header.html". Templates share one include cache, so
+% include() resolves to the already compiled objects instead of bottle
+searching and compiling the file again.
+"""
+
+import os
+import re
+from bottle import SimpleTemplate, TemplateError
+
+INCLUDE_RE = re.compile(r"""^\s*%\s*include\(\s*["']([^"']+)["']""", re.M)
+
+
+class TemplateCache(object):
+    """Compile templates under root once, optionally reload on change.
+
+    with reload=True, render() checks mtime of the template and of the
+    templates it includes and recompiles only the files that changed.
+    defaults are names available in every template (helpers like asset).
+    """
+
+    def __init__(self, root="./views", reload=False, exclude=("static",),
+                 defaults=None):
+        self.root = root
+        self.reload = reload
+        self.exclude = exclude
+        self.defaults = defaults or {}
+        self.templates = {}
+        self.mtimes = {}
+        self.includes = {}
+        self.load_all()
+
+    def names(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in self.exclude]
+            for filename in sorted(filenames):
+                if filename.endswith(".html"):
+                    path = os.path.join(dirpath, filename)
+                    yield "./" + os.path.normpath(path).replace(os.sep, "/")
+
+    def load_all(self):
+        for name in self.names():
+            self.load(name)
+
+    def load(self, name):
+        path = os.path.normpath(name)
+        with open(path, encoding="utf-8") as f:
+            source = f.read()
+        template = SimpleTemplate(source=source, name=name, lookup=["./"])
+        template.filename = path
+        template.cache = self.templates
+        template.defaults = self.defaults
+        template.co  # compile now instead of on first request
+        self.templates[name] = template
+        self.mtimes[name] = os.path.getmtime(path)
+        self.includes[name] = INCLUDE_RE.findall(source)
+        for include in self.includes[name]:
+            if include not in self.templates:
+                self.load(include)
+        return template
+
+    def changed(self, name, seen=None):
+        """Reload name and its includes if their files changed."""
+        seen = seen if seen is not None else set()
+        if name in seen:
+            return
+        seen.add(name)
+        path = os.path.normpath(name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return
+        if mtime != self.mtimes.get(name):
+            self.load(name)
+        for include in self.includes.get(name, ()):
+            self.changed(include, seen)
+
+    def get(self, name):
+        if self.reload:
+            self.changed(name)
+        template = self.templates.get(name)
+        if template is None:
+            try:
+                template = self.load(name)
+            except OSError:
+                raise TemplateError("Template {} not found.".format(name))
+        return template
+
+    def render(self, name, **kwargs):
+        return self.get(name).render(kwargs)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+
+"""Sanitizer regressions, run from repository root:
+
+    python -m unittest discover tests
+"""
+
+import unittest
+
+import markup
+
+
+def clean(html):
+    return markup.sanitize(html)[0]
+
+
+class DroppedContentTest(unittest.TestCase):
+    """content after a dropped element must survive."""
+
+    def test_void_dropped_tag(self):
+        self.assertEqual(clean("<p>before</p><embed src=x><p>after</p>"),
+                         "<p>before</p><p>after</p>")
+
+    def test_void_tag_inside_dropped(self):
+        self.assertEqual(clean("<object><param name=a></object><p>x</p>"),
+                         "<p>x</p>")
+
+    def test_optional_end_tags_inside_dropped(self):
+        self.assertEqual(clean("<select><option>a<option>b</select><p>x</p>"),
+                         "<p>x</p>")
+
+    def test_unclosed_tags_inside_dropped(self):
+        self.assertEqual(clean("<svg><circle r=1></svg><p>x</p>"), "<p>x</p>")
+
+    def test_nested_dropped(self):
+        self.assertEqual(clean("<svg><svg><g></svg></svg><p>x</p>"), "<p>x</p>")
+
+    def test_self_closing_dropped(self):
+        self.assertEqual(clean("<svg/><p>x</p>"), "<p>x</p>")
+
+    def test_script_text(self):
+        self.assertEqual(clean("<script>a<b>c</script><p>x</p>"), "<p>x</p>")
+
+
+class IframeTest(unittest.TestCase):
+
+    def test_scheme_relative_embed(self):
+        self.assertEqual(clean('<iframe src="//www.youtube.com/embed/x"></iframe>'),
+                         '<iframe src="https://www.youtube.com/embed/x"></iframe>')
+
+    def test_unknown_host_dropped(self):
+        self.assertEqual(clean('<iframe src="https://evil.example/"><p>in</p>'
+                               '</iframe><p>x</p>'), "<p>x</p>")
+
+
+class LegacyHtmlTest(unittest.TestCase):
+
+    def test_indented_html_is_not_code(self):
+        source = "<div>\n    <p>text</p>\n</div>"
+        self.assertEqual(markup.render(source, markup.HTML).html,
+                         "<div>\n    <p>text</p>\n</div>")
+
+
+if __name__ == "__main__":
+    unittest.main()
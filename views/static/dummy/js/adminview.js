@@ -11,3 +11,22 @@ $("#rrmove").click(function(event){
         location.reload();
     });
 });
+
+$("#imgupload").change(function(){
+    if (!this.files.length) {
+        return;
+    }
+    var data = new FormData();
+    data.append("image", this.files[0]);
+    $("#imgstatus").text("Uploading...");
+    $.ajax({url: "/admin/images", type: "POST", data: data,
+            processData: false, contentType: false}).always(function(result){
+        result = result.responseJSON || result;
+        if (result.status === "OK") {
+            $("#imgurl").val(result.url);
+            $("#imgstatus").text("Uploaded.");
+        } else {
+            $("#imgstatus").text(result.error || "Upload failed.");
+        }
+    });
+});
@@ -59,4 +59,10 @@ $(".message").on("click", "#removeMessage", function(){
         location.replace("/admin/messages");
     });
 });
+$("#markAllRead").click(function(event){
+    event.preventDefault();
+    $.post("/admin/messages", {action: "seen", all: 1}).then(function(){
+        location.reload();
+    });
+});
 $('iframe').wrapAll('<div class="embed-responsive embed-responsive-16by9">');